@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Batch Compliance Test for LSD server test
+File Name: lsd_batch.py
+Files: lsd_batch.py(Script file for batch test), lsd_client.py(Interactions used by every file)
+Detail: This script runs one LSD interaction over many epub files in a single process and prints one aggregated report.
+    Usage
+     $ python lsd_batch.py -i %interaction_name -d %device_id -n %device_name -e %end_date -w %workers -m %mode -o %report_file -t %timeout -s %schema -l %license_cache -p %processes -x %metrics_file -r %results_file -f -R %archive | -P %archive -S %speed -E %event_sample $source
+       %interaction_name : fetch, fetch_license, register, renew or return (see lsd_client.py)
+       %device_id : device id
+       %device_name : device name
+       %end_date : expired date (renew only)
+       %workers : number of concurrent workers. default value: 4
+       %mode : thread or process. default value: thread
+               process splits the files into shards run by %processes processes with %workers threads each
+       %report_file : write the report to this file instead of stdout
+       %timeout : http connect and read timeout in seconds. default value: 30
+       %schema : status document schema, new, old or path of schema file. default value: new
+       %license_cache : json index file of extracted License Documents, unchanged epub files are not opened again
+       %processes : number of processes extracting License Documents missing in the cache, and running shards
+                    in process mode. default value: number of CPUs
+       %metrics_file : file of per-phase durations of every request, Prometheus text for .prom and json otherwise
+       %results_file : SQLite file that records every outcome as soon as it is done (see lsd_results.py).
+                       files already recorded for the interaction and device are skipped, -f runs the failed ones again
+       %archive, %speed : record traffic into an archive or replay it, see lsd_client.py and lsd_replay.py
+       %event_sample : max number of events of Status Documents kept and validated, see lsd_client.py
+       %source : directory of epub files, glob pattern (e.g. "books/**/*.epub") or manifest file with one epub path per line
+"""
+
+import glob
+import json
+import os
+import sys
+import time
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import lsd_client
+import lsd_replay
+import lsd_results
+
+# max files of one shard in process mode, results reach the parent and the result store when their shard is done
+SHARD_SIZE = 64
+
+
+def collect_epub_files(source):
+    """
+    Args:
+        source (str): Directory, glob pattern, single epub file or manifest file (one path per line, '#' for comments).
+
+    Returns:
+        list: Sorted paths of epub files.
+    """
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, '**', '*.epub'), recursive=True))
+    if glob.has_magic(source):
+        return sorted(glob.glob(source, recursive=True))
+    if source.lower().endswith('.epub'):
+        return [source]
+
+    with open(source) as manifest:
+        return [line.strip() for line in manifest
+                if line.strip() and not line.lstrip().startswith('#')]
+
+
+def _read_license_document(path):
+    try:
+        return lsd_client.read_license_document(path)
+    except Exception as e:
+        return {"Function": "get_license_document",
+                "Message": lsd_client.format_error(e)}
+
+
+def extract_license_documents(epub_files, processes=None, cache=None):
+    """
+    Args:
+        epub_files (list): Paths of Epub files.
+        processes (int): Number of worker processes. default value: None, number of CPUs
+        cache (lsd_client.LicenseCache): Cache that is looked up first and filled with extracted documents.
+            default value: None, lsd_client.license_cache
+
+    Returns:
+        dict: License Document (or error of get_license_document) of each path.
+    """
+    cache = cache or lsd_client.license_cache
+    license_documents = dict()
+    missing = list()
+    for epub_file in epub_files:
+        try:
+            license_document = cache.get(epub_file) if cache is not None else None
+        except OSError:
+            license_document = None
+        if license_document is None:
+            missing.append(epub_file)
+        else:
+            license_documents[epub_file] = license_document
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunksize = max(1, len(missing) // ((processes or os.cpu_count() or 1) * 4))
+            for epub_file, license_document in zip(missing, executor.map(_read_license_document, missing,
+                                                                         chunksize=chunksize)):
+                license_documents[epub_file] = license_document
+                if cache is not None and 'Function' not in license_document:
+                    cache.put(epub_file, license_document)
+
+    return license_documents
+
+
+def run_one(epub_file, instruction, device_id, device_name, end_date=None):
+    """
+    Args:
+        epub_file (str): Path of Epub file.
+        instruction (str): Interaction name.
+        device_id (str): Device ID
+        device_name (str): Device name
+        end_date (str): ISO8601 end date. default value: None
+
+    Returns:
+        dict: Result of one file -- epub_file, result, http_code, elapsed and records (lsd_client.InteractionResult).
+    """
+    start = time.perf_counter()
+    details = dict()
+    try:
+        res, _ = lsd_client.run_interaction(epub_file, instruction, device_id, device_name, end_date, details)
+    except Exception as e:
+        # a malformed file fails alone, the other files of the batch are still run and reported
+        res = "Function: run_one\nMessage: " + lsd_client.format_error(e)
+    return {"epub_file": epub_file,
+            "result": res,
+            "http_code": details.get('http_code'),
+            "elapsed": time.perf_counter() - start,
+            "records": details.get('records', [])}
+
+
+def run_batch(epub_files, instruction, device_id, device_name, end_date=None, workers=4, mode='thread', store=None,
+              retry_failures=False, processes=None):
+    """
+    Args:
+        epub_files (list): Paths of Epub files.
+        instruction (str): Interaction name.
+        device_id (str): Device ID
+        device_name (str): Device name
+        end_date (str): ISO8601 end date. default value: None
+        workers (int): Number of concurrent workers, per process in process mode. default value: 4
+        mode (str): 'thread' or 'process'. default value: 'thread'
+        store (lsd_results.ResultStore): Store that records every result as soon as it is done, files already
+            recorded for the interaction and device are skipped. default value: None
+        retry_failures (bool): Run files whose recorded result failed again. default value: False
+        processes (int): Number of processes in process mode. default value: None, number of CPUs
+
+    Returns:
+        list: Result of every file run, in the order of epub_files.
+    """
+    args = (instruction, device_id, device_name, end_date)
+
+    def record(result):
+        if store is not None:
+            store.record(result['epub_file'], instruction, device_id, device_name, result['result'],
+                         result['http_code'], result['elapsed'], end_date, result['records'])
+        return result
+
+    def run(epub_file):
+        return record(run_one(epub_file, *args))
+
+    if store is not None:
+        completed = store.completed(instruction, device_id, include_failures=not retry_failures)
+        epub_files = [epub_file for epub_file in epub_files if epub_file not in completed]
+
+    if mode == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, epub_files))
+    elif mode == 'process':
+        return run_sharded(epub_files, instruction, device_id, device_name, end_date, processes=processes,
+                           workers=workers, on_result=record)
+    else:
+        raise ValueError("Unknown mode: {}".format(mode))
+
+
+# settings of this worker process, applied again only when a shard comes with other ones
+_shard_settings = None
+
+
+def _prepare_shard_worker(settings):
+    global _shard_settings
+    if settings == _shard_settings:
+        return
+    schema_file, workers, timeout, license_cache_file, event_sample, replay = settings
+    lsd_client.set_status_schema(schema_file)
+    lsd_client.set_status_event_sample(event_sample)
+    # sockets of a forked parent must not be shared, every process gets a pool of its own
+    lsd_client.configure_connection_pool(pool_size=workers, timeout=timeout)
+    if replay is not None:
+        # spawned workers do not inherit the replay pool of the main process
+        lsd_replay.start_replay(*replay)
+    if license_cache_file is not None:
+        lsd_client.set_license_cache(license_cache_file)
+    try:
+        # built once per process here, instead of inside the first timed interaction
+        lsd_client.get_status_validator()
+    except Exception:
+        # fetch_status reports the same error for every file
+        pass
+    _shard_settings = settings
+
+
+def _run_shard(settings, trace, epub_files, instruction, device_id, device_name, end_date):
+    _prepare_shard_worker(settings)
+    tracer = lsd_client.PhaseTracer() if trace else None
+    lsd_client.set_tracer(tracer)
+    results = run_batch(epub_files, instruction, device_id, device_name, end_date, workers=settings[1])
+    return results, tracer
+
+
+def run_sharded(epub_files, instruction, device_id, device_name, end_date=None, processes=None, workers=4,
+                on_result=None):
+    """
+    Args:
+        epub_files (list): Paths of Epub files.
+        instruction (str): Interaction name.
+        device_id (str): Device ID
+        device_name (str): Device name
+        end_date (str): ISO8601 end date. default value: None
+        processes (int): Number of worker processes. default value: None, number of CPUs
+        workers (int): Number of threads in every process. default value: 4
+        on_result (callable): Called in this process with each result as soon as its shard is done. default value: None
+
+    Returns:
+        list: Result of every file, in the order of epub_files. Phase durations of the workers are merged into
+            lsd_client.tracer when it is set.
+    """
+    processes = processes or os.cpu_count() or 1
+    if not epub_files:
+        return list()
+    # a few shards per process, so a process that got slow files does not keep the others waiting at the end
+    # shards are also kept small, so a crash loses at most the unfinished shards of each process
+    shard_count = min(len(epub_files), max(processes * 4, -(-len(epub_files) // SHARD_SIZE)))
+    license_cache_file = None
+    if lsd_client.license_cache is not None:
+        lsd_client.license_cache.save()
+        license_cache_file = lsd_client.license_cache.index_file
+    replay = None
+    if isinstance(lsd_client.connection_pool, lsd_replay.ReplayConnectionPool):
+        replay = (lsd_client.connection_pool.path, lsd_client.connection_pool.speed)
+    settings = (lsd_client.status_schema_file, workers, lsd_client.connection_pool.timeout, license_cache_file,
+                lsd_client.status_event_sample, replay)
+
+    results = [None] * len(epub_files)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = dict()
+        for shard in range(shard_count):
+            future = executor.submit(_run_shard, settings, lsd_client.tracer is not None, epub_files[shard::shard_count],
+                                     instruction, device_id, device_name, end_date)
+            futures[future] = shard
+        for future in as_completed(futures):
+            shard_results, tracer = future.result()
+            results[futures[future]::shard_count] = shard_results
+            if tracer is not None:
+                lsd_client.tracer.merge(tracer)
+            if on_result is not None:
+                for result in shard_results:
+                    on_result(result)
+    return results
+
+
+def aggregate_report(results, instruction):
+    """
+    Args:
+        results (list): Results from run_batch.
+        instruction (str): Interaction name.
+
+    Returns:
+        dict: Aggregated report -- totals, outcomes counted by result message, pass/fail histograms of every
+            endpoint, and every file result.
+    """
+    errors = [r for r in results if r['result'] is None or r['result'].startswith(('Function:', 'Type:'))]
+    elapsed = [r['elapsed'] for r in results]
+    histogram = lsd_client.ResultHistogram()
+    for r in results:
+        histogram.update(r.get('records', ()))
+
+    return {"instruction": instruction,
+            "files": len(results),
+            "errors": len(errors),
+            "total_elapsed": sum(elapsed),
+            "max_elapsed": max(elapsed) if elapsed else 0.0,
+            "outcomes": dict(Counter(r['result'] for r in results)),
+            "endpoints": histogram.to_dict(),
+            "results": [{key: value for key, value in r.items() if key != 'records'} for r in results]}
+
+
+def main():
+    """
+
+    """
+
+    def usage():
+        print("Usage: lsd_batch.py [-option] [value] [Directory|Glob|Manifest]")
+        print("[option]")
+        print("-i Interaction [fetch|fetch_license|register|renew|return]")
+        print("-d Device id")
+        print("-n Device name")
+        print("-e ISO8601 end date")
+        print("-w Number of workers (default: 4)")
+        print("-m Worker mode [thread|process] (default: thread)")
+        print("-o Report file (default: stdout)")
+        print("-t Http timeout in seconds (default: 30)")
+        print("-s Status document schema [new|old|schema file] (default: new)")
+        print("-l License cache index file")
+        print("-p Number of processes extracting License Documents into the cache, and of process mode (default: number of CPUs)")
+        print("-x Phase metrics file, Prometheus text for .prom and json otherwise")
+        print("-r Results file (SQLite), recorded files are skipped by a rerun")
+        print("-f Run files whose recorded result failed again")
+        print("-R Record every request and response into this archive file (not in process mode)")
+        print("-P Replay responses from this archive file instead of the server")
+        print("-S Replay speed, recorded latency is divided by it, 0 for none (default: 1)")
+        print("-E Max number of events of Status Documents kept and validated, sampled (default: all)")
+
+    args = lsd_client.parse_arguments()
+    for idx in range(len(sys.argv)):
+        if sys.argv[idx] == '-w':
+            args['workers'] = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-m':
+            args['mode'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-o':
+            args['report_file'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-t':
+            args['timeout'] = float(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-p':
+            args['processes'] = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-r':
+            args['results_file'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-f':
+            args['retry_failures'] = True
+
+    if len(sys.argv) < 2 or not all(key in args for key in ('instruction', 'dev_id', 'dev_name')):
+        usage()
+        exit()
+    if 'record' in args and args.get('mode') == 'process':
+        # forked workers would write into the same archive
+        print("Recording is not supported in process mode.")
+        exit()
+
+    if 'schema' in args:
+        lsd_client.set_status_schema(args['schema'])
+    if 'event_sample' in args:
+        lsd_client.set_status_event_sample(args['event_sample'])
+    # one keep-alive connection per worker and host
+    lsd_client.configure_connection_pool(pool_size=args.get('workers', 4), timeout=args.get('timeout', 30))
+    recorder = lsd_replay.configure_traffic(args)
+    if 'metrics' in args:
+        lsd_client.set_tracer(lsd_client.PhaseTracer())
+    epub_files = collect_epub_files(args['epub_file'])
+    if 'license_cache' in args:
+        lsd_client.set_license_cache(args['license_cache'])
+        extract_license_documents(epub_files, processes=args.get('processes'))
+    store = lsd_results.ResultStore(args['results_file']) if 'results_file' in args else None
+    results = run_batch(epub_files, args['instruction'], args['dev_id'], args['dev_name'],
+                        end_date=args.get('end_date'), workers=args.get('workers', 4),
+                        mode=args.get('mode', 'thread'), store=store,
+                        retry_failures=args.get('retry_failures', False), processes=args.get('processes'))
+    if store is not None:
+        # the report covers the whole campaign, also the files recorded by earlier runs, endpoint histograms are
+        # counted from the stored records
+        selected = set(epub_files)
+        results = [result for result in store.results(args['instruction'], args['dev_id'])
+                   if result['epub_file'] in selected]
+        store.close()
+    if lsd_client.license_cache is not None:
+        lsd_client.license_cache.save()
+    if 'metrics' in args:
+        lsd_client.tracer.export(args['metrics'])
+    if recorder is not None:
+        recorder.finish()
+    report = json.dumps(aggregate_report(results, args['instruction']), indent=4)
+
+    if 'report_file' in args:
+        with open(args['report_file'], 'w') as report_file:
+            report_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Benchmark for LSD client
+File Name: lsd_benchmark.py
+Files: lsd_benchmark.py(Script file for benchmark), lsd_client.py(Functions measured)
+Detail: This script measures client side costs of lsd_client.py, so regressions of the client can be found without a server.
+    Usage
+     $ python lsd_benchmark.py %benchmark_name
+       %benchmark_name : which is one of following ones
+         - time_parser : convert_time_to_utc against the strptime based parser of lsd_client.py v1.0
+         - interactions : interactions per second and p50/p99 latency of fetch and every do_* path against lsd_mock_server.py
+         - import_time : time to import lsd_client.py in a new interpreter, against IMPORT_TIME_BUDGET_MS
+         - json_codec : parse time of status and license documents from response bytes, per JSON backend of lsd_client.py
+         - large_status : time and peak memory of parse and validation of a Status Document with 100k events, full against sampled events
+         - links : build time of renew urls, link index and compiled URI template against the link scan of lsd_client.py v1.0
+"""
+
+import base64
+import json
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+import lsd_client
+import lsd_mock_server
+
+# import of lsd_client.py on top of interpreter startup, per-file runs pay it on every invocation.
+# stdlib modules it needs (json, re, datetime, urllib.parse) take most of it; measured with cached bytecode
+IMPORT_TIME_BUDGET_MS = 50.0
+
+
+def legacy_convert_time_to_utc(time_in_timezone):
+    """
+    Args:
+        time_in_timezone (str): datetime in ISO 8601 format
+
+    Returns:
+        datetime: Converted datetime in UTC, convert_time_to_utc of lsd_client.py v1.0 kept for comparison.
+    """
+    if time_in_timezone.find('Z') > 0:
+        return datetime.strptime(time_in_timezone, "%Y-%m-%dT%H:%M:%SZ")
+    else:
+        tz_loc = time_in_timezone.find('+')
+        if tz_loc == -1:
+            tz_loc = time_in_timezone.find('-')
+        new_time = datetime.strptime(time_in_timezone[:tz_loc], "%Y-%m-%dT%H:%M:%S")
+        tz_delta = timedelta(hours=int(time_in_timezone[tz_loc + 1:tz_loc + 3]),
+                             minutes=int(time_in_timezone[-2:]))
+        if time_in_timezone[tz_loc] == '-':
+            return new_time + tz_delta
+        elif time_in_timezone[tz_loc] == '+':
+            return new_time - tz_delta
+
+
+def legacy_get_renew_link(status_document, end_date, device_id, device_name):
+    """
+    Args:
+        status_document (dict): Status Document
+        end_date (str): License expired date requested by client.
+        device_id (str): Device ID
+        device_name (str): Device name
+
+    Returns:
+        str: Url for "request renew", get_renew_link and generate_query of lsd_client.py v1.0 kept for comparison.
+            device_id and device_name are not percent-encoded.
+    """
+    renew_link = str()
+    for renew in status_document['links']['renew']:
+        if 'type' in renew and renew['type'] == "application/vnd.readium.lcp.license-1.0+json":
+            renew_link = renew['href']
+
+    low_idx = renew_link.find('{')
+    high_idx = renew_link.find('}')
+    template_query = renew_link[low_idx:high_idx + 1]
+    query_str = '?' if template_query[1] == '?' else str()
+    for key in template_query[2:-1].split(','):
+        if key == 'id':
+            query_str += 'id=' + device_id + '&'
+        elif key == 'name':
+            query_str += 'name=' + device_name + '&'
+        elif key == 'end':
+            query_str += 'end=' + lsd_client.quote(end_date) + '&'
+    return renew_link.replace(template_query, query_str[:-1])
+
+
+def measure(function, number):
+    """
+    Args:
+        function (callable): Function without arguments.
+        number (int): Number of calls in one round.
+
+    Returns:
+        float: Best time of one call in microseconds over 5 rounds.
+    """
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def benchmark_time_parser(number=20000):
+    """
+    Args:
+        number (int): Number of calls in one round. default value: 20000
+
+    Returns:
+        dict: Microseconds per call -- legacy parser, new parser without cache, new parser with cache.
+    """
+    # timestamps as found in status documents, every eval_*_result call parses a few of them
+    timestamps = ['2016-09-08T10:15:30Z', '2016-09-08T19:15:30+09:00', '2017-01-01T00:00:00Z',
+                  '2016-12-31T18:00:00+05:30']
+    parse = lsd_client.convert_time_to_utc.__wrapped__
+    cached = lsd_client.convert_time_to_utc
+
+    return {"legacy": measure(lambda: [legacy_convert_time_to_utc(t) for t in timestamps], number) / len(timestamps),
+            "uncached": measure(lambda: [parse(t) for t in timestamps], number) / len(timestamps),
+            "cached": measure(lambda: [cached(t) for t in timestamps], number) / len(timestamps)}
+
+
+def _quantile(sorted_values, q):
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))] if sorted_values else 0.0
+
+
+def benchmark_interactions(count=200, latency=0.0):
+    """
+    Args:
+        count (int): Number of interactions per path, each on a license of its own. default value: 200
+        latency (float): Seconds of server latency injected by the mock server. default value: 0.0
+
+    Returns:
+        dict: Interactions per second, p50 and p99 latency in milliseconds and failures of each path.
+    """
+    end_date = (datetime.utcnow() + timedelta(days=60)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    device_id, device_name = 'benchmark-device', 'benchmark'
+    old_schema = lsd_client.STATUS_SCHEMA_FILES['old']
+
+    def fetch(license_document):
+        status_document = lsd_client.get_status_document(license_document, device_id, device_name)
+        return lsd_client.fetch_status(status_document, old_schema)[0]
+
+    # renew and return start from active licenses, so every run measures exactly one do_* call
+    paths = [('fetch', 'ready', fetch, 'Syntax is correct.'),
+             ('do_register', 'ready',
+              lambda license_document: lsd_client.do_register(license_document, device_id, device_name),
+              'Server response is 200'),
+             ('do_renew', 'active',
+              lambda license_document: lsd_client.do_renew(license_document, end_date, device_id, device_name),
+              'Server response is 200'),
+             ('do_return', 'active',
+              lambda license_document: lsd_client.do_return(license_document, device_id, device_name),
+              'Server response is 200')]
+
+    report = dict()
+    with lsd_mock_server.MockLSDServer(latency=latency, schema='old') as server:
+        for name, status, interaction, expected in paths:
+            license_documents = [server.add_license(status=status) for _ in range(count)]
+            latencies = list()
+            failures = 0
+            start = time.perf_counter()
+            for license_document in license_documents:
+                call_start = time.perf_counter()
+                result = interaction(license_document)
+                latencies.append(time.perf_counter() - call_start)
+                failures += result != expected
+            elapsed = time.perf_counter() - start
+            latencies.sort()
+            report[name] = {"per_second": count / elapsed,
+                            "p50_ms": _quantile(latencies, 0.5) * 1000,
+                            "p99_ms": _quantile(latencies, 0.99) * 1000,
+                            "failures": failures}
+    lsd_client.connection_pool.close()
+    return report
+
+
+def benchmark_import_time(repeat=10):
+    """
+    Args:
+        repeat (int): Number of new interpreters for each measurement. default value: 10
+
+    Returns:
+        dict: Best milliseconds of interpreter startup, of startup with import of lsd_client, the import alone and the budget.
+    """
+    def best_ms(code):
+        timings = list()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', code])
+            timings.append(time.perf_counter() - start)
+        return min(timings) * 1000
+
+    startup = best_ms('pass')
+    with_import = best_ms('import lsd_client')
+    return {"startup_ms": startup,
+            "with_import_ms": with_import,
+            "import_ms": with_import - startup,
+            "budget_ms": IMPORT_TIME_BUDGET_MS}
+
+
+def sample_documents(events=500):
+    """
+    Args:
+        events (int): Number of events in the Status Document. default value: 500
+
+    Returns:
+        dict: Response bytes of a Status Document of a license used by many devices and of an LCP License Document.
+    """
+    with lsd_mock_server.MockLSDServer(schema='old') as server:
+        license_document = server.add_license()
+        status_document = server.status_document(license_document['id'])
+    status_document['events'] = [{"type": "register", "id": "device-{}".format(idx), "name": "reader {}".format(idx),
+                                  "timestamp": lsd_mock_server.now_timestamp()} for idx in range(events)]
+
+    # encryption and signature take most of a real License Document
+    license_document.update({
+        "encryption": {"profile": "http://readium.org/lcp/basic-profile",
+                       "content_key": {"algorithm": "http://www.w3.org/2001/04/xmlenc#aes256-cbc",
+                                       "encrypted_value": base64.b64encode(bytes(64)).decode()},
+                       "user_key": {"algorithm": "http://www.w3.org/2001/04/xmlenc#sha256",
+                                    "text_hint": "Enter your email address",
+                                    "key_check": base64.b64encode(bytes(64)).decode()}},
+        "user": {"id": "user-1", "email": base64.b64encode(bytes(48)).decode(), "encrypted": ["email"]},
+        "signature": {"algorithm": "http://www.w3.org/2001/04/xmldsig-more#rsa-sha256",
+                      "certificate": base64.b64encode(bytes(1400)).decode(),
+                      "value": base64.b64encode(bytes(256)).decode()}})
+    return {"status_document": json.dumps(status_document).encode(),
+            "license_document": json.dumps(license_document).encode()}
+
+
+def benchmark_json_codec(number=200):
+    """
+    Args:
+        number (int): Number of parses in one round. default value: 200
+
+    Returns:
+        dict: Microseconds per parse of each document -- decode and json.loads as lsd_client.py v1.0 did,
+            json_loads with each installed backend.
+    """
+    previous = lsd_client.json_backend
+    backends = ['json']
+    try:
+        lsd_client.set_json_backend('orjson')
+        backends.append('orjson')
+    except ImportError:
+        pass
+
+    report = dict()
+    for name, body in sorted(sample_documents().items()):
+        report[name] = {"legacy": measure(lambda: json.loads(body.decode()), number)}
+        for backend in backends:
+            lsd_client.set_json_backend(backend)
+            report[name][backend] = measure(lambda: lsd_client.json_loads(body), number)
+    lsd_client.set_json_backend(previous)
+    return report
+
+
+def benchmark_large_status(events=100000, sample_size=100):
+    """
+    Args:
+        events (int): Number of events in the Status Document. default value: 100000
+        sample_size (int): Number of sampled events of parse_status_document. default value: 100
+
+    Returns:
+        dict: Milliseconds and peak MiB of parse, and milliseconds of schema validation -- full json_loads
+            against parse_status_document.
+    """
+    body = sample_documents(events)['status_document']
+    validator = lsd_client.get_status_validator(lsd_client.STATUS_SCHEMA_FILES['old'])
+    parsers = {"full": lsd_client.json_loads,
+               "sampled": lambda data: lsd_client.parse_status_document(data, sample_size)[0]}
+
+    report = {"body_mib": {"size": len(body) / 2.0 ** 20}}
+    for name, parse in sorted(parsers.items()):
+        tracemalloc.start()
+        document = parse(body)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report[name] = {"parse_ms": min(timeit.repeat(lambda: parse(body), number=1, repeat=3)) * 1000,
+                        "peak_mib": peak / 2.0 ** 20,
+                        "validate_ms": min(timeit.repeat(lambda: validator.is_valid(document), number=1,
+                                                         repeat=3)) * 1000}
+    return report
+
+
+def benchmark_links(number=20000):
+    """
+    Args:
+        number (int): Number of calls in one round. default value: 20000
+
+    Returns:
+        dict: Microseconds per renew url -- legacy scan and query building, link index and compiled template.
+    """
+    # renew links of a Status Document, one per media type
+    status_document = {"links": {"renew": [
+        {"href": "https://lsd.example.com/licenses/1/renew{?end,id,name}", "type": "text/html", "templated": True},
+        {"href": "https://lsd.example.com/licenses/1/renew{?end,id,name}", "type": lsd_client.LICENSE_MEDIA_TYPE,
+         "templated": True}]}}
+    arguments = (status_document, '2017-01-01T00:00:00Z', 'device-1', 'reader')
+
+    return {"legacy": measure(lambda: legacy_get_renew_link(*arguments), number),
+            "indexed": measure(lambda: lsd_client.get_renew_link(*arguments), number)}
+
+
+BENCHMARKS = {'time_parser': benchmark_time_parser,
+              'interactions': benchmark_interactions,
+              'import_time': benchmark_import_time,
+              'json_codec': benchmark_json_codec,
+              'large_status': benchmark_large_status,
+              'links': benchmark_links}
+
+
+def main():
+    """
+
+    """
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print("Usage: lsd_benchmark.py [{}]".format('|'.join(sorted(BENCHMARKS))))
+        exit()
+
+    result = BENCHMARKS[sys.argv[1]]()
+    for name, value in sorted(result.items()):
+        if isinstance(value, dict):
+            print("{:<12} ".format(name) + "  ".join("{} {:10.3f}".format(key, value[key]) for key in sorted(value)))
+        elif name.endswith('_ms'):
+            print("{:<14} {:10.3f} ms".format(name, value))
+        else:
+            print("{:<12} {:10.3f} us".format(name, value))
+    if sys.argv[1] == 'import_time' and result['import_ms'] > result['budget_ms']:
+        print("Import time is over budget.")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,11 +9,11 @@ History
     Updated by Ahram Oh(aroh@drminside.com) on 09.08.2016 v1.0
 Files: lsd_client.py(Script file for test), json_schema_lsd.json(For check validation of Status document)
 Tools: Python 3.5.2(Python software Foundation, Interpreter), PyCharm 2016.2.2 (JetBrain, IDE)
-Dependency: pytz(MIT license), jsonschema(MIT)
+Dependency: jsonschema(MIT), colorama(BSD, optional), orjson(Apache-2.0/MIT, optional)
 Prerequisites: epub files with LSD links provided by target LCP server(The Server must provide also LSDs associated with epub files)
 Detail: This script is used for verifying if a LSD server is compliant with LSD v1.0 specification
     Usage
-     $ python lsd_client.py -i %interaction_name -d %device_id -n %device_name -e %end_date $epub_file_name 
+     $ python lsd_client.py -i %interaction_name -d %device_id -n %device_name -e %end_date -s %schema -l %license_cache -x %metrics_file -R %archive | -P %archive -S %speed -E %event_sample $epub_file_name
        %interaction_name : which is one of following ones
          - fetch : fetch LSD from the server whose address is specified in the $epub_file_name
          - fetch_license : fetch License Document from the server whose address is specified in the LSD linked in $epub_file_name
@@ -23,34 +23,813 @@ Detail: This script is used for verifying if a LSD server is compliant with LSD
        %device_id : device id
        %device_name : device name
        %end_date : expired date
+       %schema : schema of status document, new(json_schema_lsd.json), old(old_json_schema_lsd.json) or path of schema file. default value: new
+       %license_cache : json index file of License Documents extracted before, unchanged epub files are not opened again. optional
+       %metrics_file : file of per-phase durations(connect, send, wait, read, decode, validate, evaluate), Prometheus text for .prom and json otherwise. optional
+       %archive : -R records every request and response into the archive, -P answers requests from it without a server (see lsd_replay.py). optional
+       %speed : replay speed, recorded latency is divided by it, 0 for none. default value: 1
+       %event_sample : max number of events of Status Documents kept and validated, sampled uniformly, for very long event histories. default value: all
        %epub_file_name : specific epub_file which is provided by server to test an LSD interaction
 """
 
-import traceback
-
-import pip
 import importlib
 import sys
 import os
 import json
-import http.client
+import collections
+import random
+import functools
+import math
+import re
+import struct
+import threading
+import zlib
 
 import time
 
 from urllib.parse import urlparse, quote
-from datetime import datetime, timedelta
-from zipfile import ZipFile
+from datetime import datetime, timedelta, timezone
+
+# jsonschema, orjson, http.client, zipfile, traceback and colorama are imported when first needed, importing this module
+# must stay cheap and free of side effects (see "python lsd_benchmark.py import_time")
+utc = timezone.utc
+
+
+def import_dependency(name):
+    """
+    Args:
+        name (str): Module name, e.g. 'jsonschema'.
+
+    Returns:
+        module: The imported module.
+
+    Raises:
+        ImportError: The module is not installed, with the pip command installing it.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        raise ImportError("{0} is required, install it with: pip install {0}".format(name.split('.')[0]))
+
+
+def format_error(e):
+    """
+    Args:
+        e (Exception): Caught exception.
+
+    Returns:
+        str: Lines of traceback.format_exception for the exception, without stack.
+    """
+    return '\n'.join(importlib.import_module('traceback').format_exception(Exception, e, None))
+
+
+# name of the JSON backend of json_loads, chosen on first use or by set_json_backend
+json_backend = None
+_json_loads = None
 
-from colorama import init, Fore
 
-if importlib.util.find_spec('pytz') is None:
-    pip.main(['install', 'pytz'])
-timezone = importlib.import_module(name='pytz').timezone
+def _stdlib_json_loads(data):
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+    return json.loads(data)
 
-if importlib.util.find_spec('jsonschema') is None:
-    pip.main(['install', 'jsonschema'])
-json_validate = importlib.import_module(name='jsonschema').validate
-exceptions = importlib.import_module(name='jsonschema').exceptions
+
+def set_json_backend(name=None):
+    """
+    Args:
+        name (str): 'orjson' or 'json'. default value: None, orjson when it is installed and json otherwise.
+
+    Returns:
+        str: Name of the backend used by json_loads from now on.
+
+    Raises:
+        ImportError: orjson is requested but not installed.
+    """
+    global json_backend, _json_loads
+    if name not in (None, 'orjson', 'json'):
+        raise ValueError("Unknown JSON backend: {}".format(name))
+    if name == 'orjson':
+        _json_loads = import_dependency('orjson').loads
+    elif name is None:
+        try:
+            _json_loads = importlib.import_module('orjson').loads
+            name = 'orjson'
+        except ImportError:
+            name = 'json'
+    if name == 'json':
+        _json_loads = _stdlib_json_loads
+    json_backend = name
+    return json_backend
+
+
+def json_loads(data):
+    """
+    Args:
+        data (bytes): JSON document as received, str is accepted too.
+
+    Returns:
+        object: Parsed document. orjson parses the bytes directly, json decodes them to str first.
+
+    Raises:
+        ValueError: The document is not valid JSON.
+    """
+    if _json_loads is None:
+        set_json_backend()
+    return _json_loads(data)
+
+
+# None parses Status Documents fully, a number keeps at most that many sampled events (see parse_status_document)
+status_event_sample = None
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def set_status_event_sample(sample_size=100):
+    """
+    Args:
+        sample_size (int): Max number of events kept in Status Documents decoded from now on, sampled uniformly
+            from the events array. None to parse the whole document. default value: 100
+    """
+    global status_event_sample
+    status_event_sample = sample_size
+
+
+def _next_kept(count, weight, sample_size, rng):
+    # reservoir sampling with geometric skips (algorithm L), no random number is drawn for skipped events
+    weight *= math.exp(math.log(1.0 - rng.random()) / sample_size)
+    if weight >= 1.0:
+        return weight, count + 1
+    return weight, count + 1 + int(math.log(1.0 - rng.random()) / math.log(1.0 - weight))
+
+
+def _sample_events(decoder, text, idx, sample_size, rng):
+    whitespace = _JSON_WHITESPACE.match
+    # the C scanner of the decoder, raw_decode adds a python call per event
+    scan_once = decoder.scan_once
+    sample = list()
+    count = 0
+    weight, next_kept = 1.0, -1
+    idx = whitespace(text, idx + 1).end()
+    if text[idx] == ']':
+        return sample, count, idx + 1
+    while True:
+        # one event at a time, only the sampled ones are kept
+        try:
+            event, idx = scan_once(text, idx)
+        except StopIteration as e:
+            raise ValueError("Expecting value in events at char {}".format(e.value))
+        if count < sample_size:
+            sample.append((count, event))
+            if count + 1 == sample_size:
+                weight, next_kept = _next_kept(count, 1.0, sample_size, rng)
+        elif count == next_kept:
+            sample[rng.randrange(sample_size)] = (count, event)
+            weight, next_kept = _next_kept(count, weight, sample_size, rng)
+        count += 1
+        char = text[idx]
+        if char != ',' and char != ']':
+            idx = whitespace(text, idx).end()
+            char = text[idx]
+        if char == ',':
+            idx += 1
+            if text[idx] in ' \t\n\r':
+                idx = whitespace(text, idx).end()
+        elif char == ']':
+            sample.sort(key=lambda item: item[0])
+            return [event for _, event in sample], count, idx + 1
+        else:
+            raise ValueError("Expecting ',' delimiter or ']' in events at char {}".format(idx))
+
+
+def _check_end(text, idx, value):
+    # only whitespace may follow the document, as json.loads requires
+    end = _JSON_WHITESPACE.match(text, idx).end()
+    if end != len(text):
+        raise ValueError("Extra data at char {}".format(end))
+    return value
+
+
+def parse_status_document(body, sample_size=100):
+    """
+    Args:
+        body (bytes): Status Document as received, str is accepted too.
+        sample_size (int): Max number of events kept. default value: 100
+
+    Returns:
+        dict: Status Document whose events array holds only a uniform sample of the events, in their order.
+            status, updated, links and every other member are complete.
+        int: Number of events in the document, None when it has no events array.
+
+    Raises:
+        ValueError: The document is not valid JSON.
+    """
+    text = body.decode('utf-8') if isinstance(body, (bytes, bytearray)) else body
+    decoder = json.JSONDecoder()
+    whitespace = _JSON_WHITESPACE.match
+    # a fixed seed, so the same document gives the same sample
+    rng = random.Random(0)
+    event_count = None
+    try:
+        idx = whitespace(text, 0).end()
+        if text[idx] != '{':
+            return json_loads(text), event_count
+        document = dict()
+        idx = whitespace(text, idx + 1).end()
+        if text[idx] == '}':
+            return document, _check_end(text, idx + 1, event_count)
+        while True:
+            if text[idx] != '"':
+                raise ValueError("Expecting property name enclosed in double quotes at char {}".format(idx))
+            key, idx = json.decoder.scanstring(text, idx + 1)
+            idx = whitespace(text, idx).end()
+            if text[idx] != ':':
+                raise ValueError("Expecting ':' delimiter at char {}".format(idx))
+            idx = whitespace(text, idx + 1).end()
+            if key == 'events' and text[idx] == '[':
+                document[key], event_count, idx = _sample_events(decoder, text, idx, sample_size, rng)
+            else:
+                document[key], idx = decoder.raw_decode(text, idx)
+            idx = whitespace(text, idx).end()
+            if text[idx] == ',':
+                idx = whitespace(text, idx + 1).end()
+            elif text[idx] == '}':
+                return document, _check_end(text, idx + 1, event_count)
+            else:
+                raise ValueError("Expecting ',' delimiter or '}}' at char {}".format(idx))
+    except IndexError:
+        raise ValueError("Unterminated JSON document")
+
+
+def decode_status_document(body):
+    """
+    Args:
+        body (bytes): Status Document, or problem document, as received.
+
+    Returns:
+        dict: Parsed document, with sampled events when set_status_event_sample was called.
+    """
+    if status_event_sample is None:
+        return json_loads(body)
+    return parse_status_document(body, status_event_sample)[0]
+
+# "old" follows the old lsd specification
+STATUS_SCHEMA_FILES = {'new': 'json_schema_lsd.json', 'old': 'old_json_schema_lsd.json'}
+status_schema_file = STATUS_SCHEMA_FILES['new']
+_status_validators = dict()
+_status_validators_lock = threading.Lock()
+
+
+class ServerClock(object):
+    """
+    Lower bound of the clock of every server, from the Date header of its responses and the time elapsed since them
+    on the monotonic clock of this process, so that it does not depend on the client clock.
+    """
+
+    def __init__(self):
+        # per host, seconds since epoch on the server clock minus time.monotonic() at the response
+        self._offsets = dict()
+
+    def observe(self, url, date, received=None):
+        """
+        Args:
+            url (str): Url of the request.
+            date (str): Date header of the response, None when the server sent none.
+            received (float): time.monotonic() when the response arrived. default value: None, now
+        """
+        if not date:
+            return
+        try:
+            server_time = importlib.import_module('email.utils').parsedate_to_datetime(date)
+        except (TypeError, ValueError):
+            return
+        if server_time.tzinfo is None:
+            server_time = server_time.replace(tzinfo=utc)
+        offset = server_time.timestamp() - (time.monotonic() if received is None else received)
+        host = urlparse(url).netloc
+        # the largest offset is the tightest bound, Date is truncated to the second
+        if offset > self._offsets.get(host, float('-inf')):
+            self._offsets[host] = offset
+
+    def now(self, url):
+        """
+        Args:
+            url (str): Url of a request to the server.
+
+        Returns:
+            datetime: The server clock is at least at this time, None when no response of the server had a Date.
+        """
+        offset = self._offsets.get(urlparse(url).netloc)
+        if offset is None:
+            return None
+        return datetime.fromtimestamp(time.monotonic() + offset, utc)
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP/HTTPS connections shared by every request function, grouped by (scheme, host).
+    """
+
+    def __init__(self, pool_size=4, timeout=30):
+        """
+        Args:
+            pool_size (int): Max number of idle connections kept per host. default value: 4
+            timeout (float): Connect and read timeout in seconds. default value: 30
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.clock = ServerClock()
+        self._idle = dict()
+        self._lock = threading.Lock()
+
+    def _new_connection(self, scheme, netloc):
+        client = importlib.import_module('http.client')
+        if scheme == 'https':
+            return client.HTTPSConnection(netloc, timeout=self.timeout)
+        return client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(*key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, headers=None, operation='request'):
+        """
+        Args:
+            method (str): Http method.
+            url (str): Absolute url, http or https.
+            headers (dict): Request headers. default value: None
+            operation (str): Name of calling function for tracing. default value: 'request'
+
+        Returns:
+            int: Http status code for server response.
+            bytes: Response body.
+        """
+        status, _, body = self.send(method, url, headers, operation)
+        return status, body
+
+    def send(self, method, url, headers=None, operation='request'):
+        """
+        Args:
+            method (str): Http method.
+            url (str): Absolute url, http or https.
+            headers (dict): Request headers. default value: None
+            operation (str): Name of calling function for tracing. default value: 'request'
+
+        Returns:
+            int: Http status code for server response.
+            http.client.HTTPMessage: Response headers.
+            bytes: Response body, not decoded so that json_loads can parse it directly.
+        """
+        url = urlparse(url)
+        key = (url.scheme, url.netloc)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        conn, reused = self._acquire(key)
+        while True:
+            try:
+                if conn.sock is None:
+                    with trace_phase(operation, 'connect'):
+                        conn.connect()
+                with trace_phase(operation, 'send'):
+                    conn.request(method, path, headers=headers or {})
+                with trace_phase(operation, 'wait'):
+                    result = conn.getresponse()
+                self.clock.observe(url.geturl(), result.getheader('Date'))
+                break
+            # http.client.RemoteDisconnected is a ConnectionResetError
+            except (ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # the server dropped an idle keep-alive connection, retry once on a fresh one
+                conn, reused = self._new_connection(*key), False
+            except Exception:
+                conn.close()
+                raise
+
+        with result, trace_phase(operation, 'read'):
+            body = result.read()
+        if result.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        return result.status, result.msg, body
+
+    def server_time(self, url):
+        """
+        Args:
+            url (str): Url of a request to the server.
+
+        Returns:
+            datetime: Lower bound of the server clock, see ServerClock.now.
+        """
+        return self.clock.now(url)
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+connection_pool = ConnectionPool()
+
+
+def configure_connection_pool(pool_size=4, timeout=30):
+    """
+    Args:
+        pool_size (int): Max number of idle connections kept per host. default value: 4
+        timeout (float): Connect and read timeout in seconds. default value: 30
+    """
+    connection_pool.close()
+    connection_pool.pool_size = pool_size
+    connection_pool.timeout = timeout
+
+
+class PhaseTracer(object):
+    """
+    Durations of each phase of the request helpers, fetch_status and evaluations, grouped by (operation, phase).
+    Phases: connect(dns and tcp/tls), send, wait(server processing until response headers), read(body),
+    decode(json), validate(schema) and evaluate(eval_*_result).
+    """
+
+    def __init__(self, max_samples=10000):
+        """
+        Args:
+            max_samples (int): Max number of durations kept per (operation, phase) for percentiles,
+                a uniform sample is kept beyond that. default value: 10000
+        """
+        self.max_samples = max_samples
+        self._phases = dict()
+        self._lock = threading.Lock()
+
+    def record(self, operation, phase, duration):
+        """
+        Args:
+            operation (str): Name of function, e.g. get_status_document.
+            phase (str): Name of phase, e.g. connect.
+            duration (float): Duration in seconds.
+        """
+        with self._lock:
+            stats = self._phases.setdefault((operation, phase), {'count': 0, 'sum': 0.0, 'samples': []})
+            stats['count'] += 1
+            stats['sum'] += duration
+            if len(stats['samples']) < self.max_samples:
+                stats['samples'].append(duration)
+            else:
+                idx = random.randrange(stats['count'])
+                if idx < self.max_samples:
+                    stats['samples'][idx] = duration
+
+    def phase(self, operation, phase):
+        """
+        Args:
+            operation (str): Name of function.
+            phase (str): Name of phase.
+
+        Returns:
+            context manager: Records the duration of its block.
+        """
+        return _TracedPhase(self, operation, phase)
+
+    def merge(self, other):
+        """
+        Args:
+            other (PhaseTracer): Tracer whose durations are added to this one, e.g. of a worker process.
+        """
+        with other._lock:
+            phases = [(key, stats['count'], stats['sum'], list(stats['samples'])) for key, stats in other._phases.items()]
+        with self._lock:
+            for key, count, total, samples in phases:
+                stats = self._phases.setdefault(key, {'count': 0, 'sum': 0.0, 'samples': []})
+                stats['count'] += count
+                stats['sum'] += total
+                stats['samples'].extend(samples)
+                if len(stats['samples']) > self.max_samples:
+                    stats['samples'] = random.sample(stats['samples'], self.max_samples)
+
+    def __getstate__(self):
+        # the lock cannot be pickled, tracers of worker processes are sent back to be merged
+        with self._lock:
+            return {'max_samples': self.max_samples, '_phases': self._phases}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def summary(self):
+        """
+        Returns:
+            dict: {operation: {phase: {count, sum, p50, p90, p99, max}}} with durations in seconds.
+        """
+        with self._lock:
+            phases = [(key, stats['count'], stats['sum'], sorted(stats['samples']))
+                      for key, stats in self._phases.items()]
+
+        summary = dict()
+        for (operation, phase), count, total, samples in phases:
+            summary.setdefault(operation, dict())[phase] = {
+                'count': count, 'sum': total,
+                'p50': _quantile(samples, 0.5), 'p90': _quantile(samples, 0.9), 'p99': _quantile(samples, 0.99),
+                'max': samples[-1] if samples else 0.0}
+        return summary
+
+    def to_json(self):
+        """
+        Returns:
+            str: Summary as json text.
+        """
+        return json.dumps(self.summary(), indent=4, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Returns:
+            str: Summary in Prometheus text exposition format, metric lsd_client_phase_seconds.
+        """
+        lines = ['# HELP lsd_client_phase_seconds Duration of each phase of LSD client operations.',
+                 '# TYPE lsd_client_phase_seconds summary']
+        for operation, phases in sorted(self.summary().items()):
+            for phase, stats in sorted(phases.items()):
+                labels = 'operation="{}",phase="{}"'.format(operation, phase)
+                for quantile in ('0.5', '0.9', '0.99'):
+                    lines.append('lsd_client_phase_seconds{{{},quantile="{}"}} {!r}'.format(
+                        labels, quantile, stats['p' + quantile[2:].ljust(2, '0')]))
+                lines.append('lsd_client_phase_seconds_sum{{{}}} {!r}'.format(labels, stats['sum']))
+                lines.append('lsd_client_phase_seconds_count{{{}}} {}'.format(labels, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """
+        Args:
+            path (str): File to write, Prometheus text when it ends with .prom, json otherwise.
+        """
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+class _TracedPhase(object):
+    def __init__(self, phase_tracer, operation, phase):
+        self._tracer = phase_tracer
+        self._operation = operation
+        self._phase = phase
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._tracer.record(self._operation, self._phase, time.perf_counter() - self._start)
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+tracer = None
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+
+def set_tracer(phase_tracer):
+    """
+    Args:
+        phase_tracer (PhaseTracer): Tracer recording phases from now on, None to stop tracing.
+    """
+    global tracer
+    tracer = phase_tracer
+
+
+def trace_phase(operation, phase):
+    """
+    Args:
+        operation (str): Name of function.
+        phase (str): Name of phase.
+
+    Returns:
+        context manager: Records the duration of its block when a tracer is set, does nothing otherwise.
+    """
+    if tracer is None:
+        return _NO_PHASE
+    return tracer.phase(operation, phase)
+
+
+
+class InteractionSession(object):
+    """
+    Latest License Document and Status Document of one device, carried through an interaction chain
+    so that the Status Document is fetched again only when no response gave the new state.
+    """
+
+    def __init__(self, license_document, device_id, device_name, status_document=None):
+        """
+        Args:
+            license_document (dict): License Document with link url for status document.
+            device_id (str): Device ID
+            device_name (str): Device name
+            status_document (dict): Status Document already fetched for the device. default value: None
+        """
+        self.license_document = license_document
+        self.device_id = device_id
+        self.device_name = device_name
+        self.status_document = status_document
+        self.http_code = None
+
+    def get_status_document(self):
+        """
+        Returns:
+            dict: Latest Status Document, fetched from server only when it is not known.
+        """
+        if self.status_document is None:
+            status_document = get_status_document(self.license_document, self.device_id, self.device_name)
+            if 'Function' in status_document.keys():
+                return status_document
+            self.status_document = status_document
+        return self.status_document
+
+    def update(self, http_code, response_value, license_document=None):
+        """
+        Args:
+            http_code (int): Http status code of an interaction.
+            response_value (dict): Response of the interaction, new status document when http_code is 200.
+            license_document (dict): New License Document fetched after the interaction. default value: None
+        """
+        self.http_code = http_code
+        if http_code == 200 and 'status' in response_value and 'type' not in response_value:
+            self.status_document = response_value
+        else:
+            # the server state is unknown after an error, fetch it again next time
+            self.status_document = None
+        if license_document:
+            self.license_document = license_document
+
+
+# verdicts of InteractionResult
+VERDICT_PASS = 'pass'
+VERDICT_FAIL = 'fail'          # server answered 200, but a check of the new documents failed
+VERDICT_REJECTED = 'rejected'  # server answered with a problem document
+VERDICT_SKIPPED = 'skipped'    # license status does not allow the interaction
+VERDICT_ERROR = 'error'        # exception or unknown response code
+
+# text of each check, InteractionResult renders the messages of lsd_client.py v1.0 from them
+RESULT_MESSAGES = {
+    None: "Server response is 200",
+    'register_status': "do_register: This epub file status is {}",
+    'register_response': "Server response is 200\nWrong response received.",
+    'register_unknown_code': "Unknown response code.",
+    'renew_status': "do_renew: License is not registration.",
+    'renew_status_updated': "Updated date in status document is not updated",
+    'renew_rights_end': "End date in Rights in license document is difference with End date",
+    'renew_license_updated': "License updated timestamp is not updated",
+    'return_status': "Status in status document is not valid. before: {} current: {}",
+    'return_lsd_license_updated': "Timestamp about license updated in lsd is not updated",
+    'return_lcp_license_updated': "Timestamp about license updated in lcp is not updated",
+    'return_status_updated': "Timestamp about status updated is not updated",
+    'return_server_error': "Server response is {} \n{} \n{}",
+    'server_error': "Server response is {}\n{}\n{}",
+    'unknown_code': "Unknown response code",
+    'exception': "Function: {}\nMessage: {}",
+}
+
+
+class InteractionResult(object):
+    """
+    Outcome of one register, renew or return interaction. str() gives the result message.
+    """
+    __slots__ = ('interaction', 'verdict', 'http_code', 'check', 'args', 'elapsed')
+
+    def __init__(self, interaction, verdict, http_code=None, check=None, args=(), elapsed=None):
+        """
+        Args:
+            interaction (str): register, renew or return, the server endpoint.
+            verdict (str): One of VERDICT_PASS, VERDICT_FAIL, VERDICT_REJECTED, VERDICT_SKIPPED, VERDICT_ERROR.
+            http_code (int): Http status code of the request, None when no request was sent. default value: None
+            check (str): Key of RESULT_MESSAGES of the failing check, None when passed. default value: None
+            args (tuple): Values of the message of the check. default value: ()
+            elapsed (float): Seconds from the request to the end of evaluation. default value: None
+        """
+        self.interaction = interaction
+        self.verdict = verdict
+        self.http_code = http_code
+        self.check = check
+        self.args = args
+        self.elapsed = elapsed
+
+    @property
+    def passed(self):
+        return self.verdict == VERDICT_PASS
+
+    def __str__(self):
+        return RESULT_MESSAGES[self.check].format(*self.args)
+
+    def __repr__(self):
+        return 'InteractionResult({!r}, {!r}, {!r}, {!r})'.format(self.interaction, self.verdict, self.http_code,
+                                                                  self.check)
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: Fields of the result and its message, for JSON reports.
+        """
+        return {"interaction": self.interaction, "verdict": self.verdict, "http_code": self.http_code,
+                "check": self.check, "elapsed": self.elapsed, "message": str(self)}
+
+
+def _problem_result(interaction, http_code, response_value, check='server_error'):
+    return InteractionResult(interaction, VERDICT_REJECTED, http_code, check,
+                             (str(http_code), response_value['type'], response_value['title']))
+
+
+class ResultHistogram(object):
+    """
+    Pass and fail counts of InteractionResult records per endpoint, with counts of verdicts, failing checks,
+    http codes and latency buckets. Records are counted, not kept.
+    """
+    LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self._counters = collections.defaultdict(collections.Counter)
+
+    def add(self, result):
+        """
+        Args:
+            result (InteractionResult): Result to count.
+        """
+        counter = self._counters[result.interaction]
+        counter[('verdict', result.verdict)] += 1
+        if result.check is not None:
+            counter[('check', result.check)] += 1
+        if result.http_code is not None:
+            counter[('http_code', result.http_code)] += 1
+        if result.elapsed is not None:
+            for bucket in self.LATENCY_BUCKETS:
+                if result.elapsed <= bucket:
+                    break
+            else:
+                bucket = float('inf')
+            counter[('latency', bucket)] += 1
+
+    def update(self, results):
+        """
+        Args:
+            results (iterable): InteractionResult records to count.
+        """
+        for result in results:
+            self.add(result)
+
+    def merge(self, other):
+        """
+        Args:
+            other (ResultHistogram): Histogram whose counts are added to this one.
+        """
+        for interaction, counter in other._counters.items():
+            self._counters[interaction].update(counter)
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: Per endpoint -- pass, fail (every other verdict), verdicts, checks, http_codes and latency,
+                latency keyed by the upper bound of the bucket in seconds.
+        """
+        report = dict()
+        for interaction, counter in sorted(self._counters.items()):
+            endpoint = {"pass": counter[('verdict', VERDICT_PASS)], "fail": 0, "verdicts": dict(), "checks": dict(),
+                        "http_codes": dict(), "latency": dict()}
+            for (kind, key), count in counter.items():
+                if kind == 'verdict':
+                    endpoint["verdicts"][key] = count
+                    if key != VERDICT_PASS:
+                        endpoint["fail"] += count
+                elif kind == 'check':
+                    endpoint["checks"][key] = count
+                elif kind == 'http_code':
+                    endpoint["http_codes"][str(key)] = count
+                else:
+                    endpoint["latency"]['+Inf' if key == float('inf') else str(key)] = count
+            report[interaction] = endpoint
+        return report
 
 
 def request_license_document(status_document):
@@ -59,43 +838,53 @@ def request_license_document(status_document):
         status_document (dict): A LSD with link url for License Document
 
     Returns:
-        str: Message that based on http status code.
-        str: License Document that received from server.
+        bytes: License Document that received from server, not decoded so that json_loads parses it directly.
+            On error, a tuple of the error message and empty bytes.
     """
     try:
-        license_link = status_document['links']['license']['href']
-
-        url = urlparse(license_link)
-        conn = http.client.HTTPConnection(url[1])
-        conn.request('GET', url[2])
+        license_link = get_link_index(status_document).href('license')
 
-        with conn.getresponse() as result:
-            return result.read().decode()
+        _, body = connection_pool.request('GET', license_link, operation='request_license_document')
+        return body
     except Exception as e:
-        return "Function: get_status\nMessage: " + '\n'.join(traceback.format_exception(Exception, e, None)), ""
+        return "Function: get_status\nMessage: " + format_error(e), b""
 
 
-def do_register(license_document, device_id, device_name):
+def do_register(license_document, device_id, device_name, session=None, as_record=False):
     """
     Args:
         license_document (dict): A License Document with link url for LSD.
         device_id (str): Device ID
         device_name (str): Device name
+        session (InteractionSession): Session of the interaction chain. default value: None, a new one
+        as_record (bool): Return the InteractionResult instead of its message. default value: False
 
     Returns:
         str: Result message for "request register" interaction.
+            InteractionResult when as_record is True.
     """
+    session = session or InteractionSession(license_document, device_id, device_name)
     try:
-        status_document = get_status_document(license_document, device_id, device_name)
+        status_document = session.get_status_document()
         if status_document['status'] != 'ready':
-            return "do_register: This epub file status is {}".format(status_document['status'])
+            record = InteractionResult('register', VERDICT_SKIPPED, check='register_status',
+                                       args=(status_document['status'],))
+            return record if as_record else str(record)
 
+        start = time.perf_counter()
         code, response_data = request_register(status_document, device_id,
                                                device_name)
-        return eval_register_result(code, status_document,
-                                    json.loads(response_data))
+        invalidate_status_cache(license_document)
+        with trace_phase('request_register', 'decode'):
+            response_value = decode_status_document(response_data)
+        session.update(code, response_value)
+        with trace_phase('eval_register_result', 'evaluate'):
+            record = check_register_result(code, status_document, response_value)
+        record.elapsed = time.perf_counter() - start
     except Exception as e:
-        return "Function: do_register\nMessage: " + '\n'.join(traceback.format_exception(Exception, e, None))
+        session.status_document = None
+        record = InteractionResult('register', VERDICT_ERROR, check='exception', args=('do_register', format_error(e)))
+    return record if as_record else str(record)
 
 
 def request_register(status_document, device_id, device_name):
@@ -107,19 +896,26 @@ def request_register(status_document, device_id, device_name):
 
     Returns:
         int: Http status code for server response.
-        str: Server response value such as error message.
+        bytes: Server response value such as error message.
     """
-    if device_id is None or device_name is None:
-        raise RuntimeError
-    activate_link = generate_query(status_document['links']['register']['href'],
-                                   device_id=device_id, device_name=device_name)
     method = 'POST'
-    url = urlparse(activate_link)
-    conn = http.client.HTTPConnection(url[1])
-    conn.request(method, url[2] + '?' + url[4])
+    return connection_pool.request(method, get_register_link(status_document, device_id, device_name),
+                                   operation='request_register')
 
-    with conn.getresponse() as result:
-        return result.status, result.read().decode()
+
+def get_register_link(status_document, device_id, device_name):
+    """
+    Args:
+        status_document (dict): A LSD with link url for "request register"
+        device_id (str): Device ID
+        device_name (str): Device name
+
+    Returns:
+        str: Url for "request register".
+    """
+    if device_id is None or device_name is None:
+        raise RuntimeError
+    return get_link_index(status_document).expand('register', {'id': device_id, 'name': device_name})
 
 
 def eval_register_result(http_code, old_status_document, response_value):
@@ -132,8 +928,18 @@ def eval_register_result(http_code, old_status_document, response_value):
     Returns:
         str: Evaluation result message. This message describe followings, server did normally process about request, license, and status document from server are correctly renewal.
     """
+    return str(check_register_result(http_code, old_status_document, response_value))
+
+
+def check_register_result(http_code, old_status_document, response_value):
+    """
+    Args:
+        See eval_register_result.
+
+    Returns:
+        InteractionResult: Verdict and failing check of "request register".
+    """
     if http_code == 200:
-        result_message = "Server response is 200"
         old_updated_status_time = convert_time_to_utc(
             old_status_document['updated']['status'])
         new_updated_status_time = convert_time_to_utc(
@@ -141,51 +947,66 @@ def eval_register_result(http_code, old_status_document, response_value):
 
         if response_value['status'] != 'active' \
                 or new_updated_status_time <= old_updated_status_time:
-            result_message += "\nWrong response received."
+            return InteractionResult('register', VERDICT_FAIL, http_code, 'register_response')
 
-        return result_message
+        return InteractionResult('register', VERDICT_PASS, http_code)
     elif http_code == 400 or http_code >= 500 or http_code < 600:
-        return "Server response is {}\n{}\n{}".format(str(http_code), response_value['type'], response_value['title'])
+        return _problem_result('register', http_code, response_value)
     else:
-        return "Unknown response code."
+        return InteractionResult('register', VERDICT_ERROR, http_code, 'register_unknown_code')
 
 
-def do_renew(license_document, end_date, device_id, device_name):
+def do_renew(license_document, end_date, device_id, device_name, session=None, as_record=False):
     """
     Args:
         license_document (dict): License Document.
         end_date (str): License expired date requested by client.
         device_id (str): Device ID
         device_name (str): Device name
+        session (InteractionSession): Session of the interaction chain. default value: None, a new one
+        as_record (bool): Return the InteractionResult instead of its message. default value: False
 
     Returns:
         str: Message of evaluation result about "request renew".
+            InteractionResult when as_record is True.
     """
+    session = session or InteractionSession(license_document, device_id, device_name)
     try:
-        status_document = get_status_document(license_document, device_id, device_name)
+        status_document = session.get_status_document()
         if status_document['status'] != 'active':
-            return "do_renew: License is not registration."
+            record = InteractionResult('renew', VERDICT_SKIPPED, check='renew_status')
+            return record if as_record else str(record)
         # check validation of end_date format using exception handler
         convert_time_to_utc(end_date)
         # Need to wait for different timestamp between old status document(//updated/status/) and new one(same path)
-        time.sleep(1)
+        renew_link = get_link_index(status_document).href('renew', LICENSE_MEDIA_TYPE)
+        time.sleep(get_timestamp_delay(status_document, license_document, connection_pool.server_time(renew_link)))
 
+        start = time.perf_counter()
         http_code, result = request_renew(status_document, end_date,
                                           device_id=device_id,
                                           device_name=device_name)
-        json_resp_data = json.loads(result)
+        invalidate_status_cache(license_document)
+        with trace_phase('request_renew', 'decode'):
+            json_resp_data = decode_status_document(result)
 
         if "type" not in json_resp_data:
-            new_lic_str = request_license_document(json_resp_data)
-            new_license = json.loads(new_lic_str)
+            new_lic_body = request_license_document(json_resp_data)
+            with trace_phase('request_license_document', 'decode'):
+                new_license = json_loads(new_lic_body)
         else:
             new_license = dict()
 
-        return eval_renew_result(http_code, json_resp_data, status_document,
-                                 new_license, license_document, end_date)
+        session.update(http_code, json_resp_data, new_license)
+        with trace_phase('eval_renew_result', 'evaluate'):
+            record = check_renew_result(http_code, json_resp_data, status_document,
+                                        new_license, license_document, end_date)
+        record.elapsed = time.perf_counter() - start
 
     except Exception as e:
-        return "Function: do_renew\nMessage: " + '\n'.join(traceback.format_exception(Exception, e, None))
+        session.status_document = None
+        record = InteractionResult('renew', VERDICT_ERROR, check='exception', args=('do_renew', format_error(e)))
+    return record if as_record else str(record)
 
 
 def request_renew(status_document, end_date, device_id, device_name):
@@ -198,27 +1019,29 @@ def request_renew(status_document, end_date, device_id, device_name):
 
     Returns:
         int: Http status code about server response
-        str: Server response message which is Status Document or error message
+        bytes: Server response message which is Status Document or error message
     """
-    if end_date is None:
-        raise RuntimeError("end_date is None")
+    method = 'PUT'
+    return connection_pool.request(method, get_renew_link(status_document, end_date, device_id, device_name),
+                                   operation='request_renew')
 
-    renew_object = status_document['links']['renew']
-    renew_link = str()
-    for renew in renew_object:
-        if 'type' in renew and renew['type'] == "application/vnd.readium.lcp.license-1.0+json":
-            renew_link = renew['href']
 
-    renew_link = generate_query(renew_link, device_id=device_id,
-                                device_name=device_name,
-                                end_date=quote(end_date))
-    method = 'PUT'
-    url = urlparse(renew_link)
-    conn = http.client.HTTPConnection(url[1])
-    conn.request(method, url[2] + '?' + url[4])
+def get_renew_link(status_document, end_date, device_id, device_name):
+    """
+    Args:
+        status_document (dict): Status Document
+        end_date (str): License expired date requested by client.
+        device_id (str): Device ID
+        device_name (str): Device name
+
+    Returns:
+        str: Url for "request renew".
+    """
+    if end_date is None:
+        raise RuntimeError("end_date is None")
 
-    with conn.getresponse() as result:
-        return result.status, result.read().decode()
+    return get_link_index(status_document).expand('renew', {'id': device_id, 'name': device_name, 'end': end_date},
+                                                  LICENSE_MEDIA_TYPE)
 
 
 def eval_renew_result(http_code, response_value, old_status_document,
@@ -236,62 +1059,90 @@ def eval_renew_result(http_code, response_value, old_status_document,
     Returns:
         str: Result message that describe correctly done of process or not, and new license document and status document is correctly renewal.
     """
+    return str(check_renew_result(http_code, response_value, old_status_document, new_license_document,
+                                  old_license_document, new_end_date))
+
+
+def check_renew_result(http_code, response_value, old_status_document,
+                       new_license_document, old_license_document,
+                       new_end_date):
+    """
+    Args:
+        See eval_renew_result.
+
+    Returns:
+        InteractionResult: Verdict and failing check of "request renew".
+    """
     if http_code == 200:
         # status: check updated/license date between old and new
         old_status_updated = convert_time_to_utc(old_status_document['updated']['license'])
         new_status_updated = convert_time_to_utc(response_value['updated']['license'])
         if old_status_updated >= new_status_updated:
-            return "Updated date in status document is not updated"
+            return InteractionResult('renew', VERDICT_FAIL, http_code, 'renew_status_updated')
 
         # license: check rights/end and new_date
         new_rights_date = convert_time_to_utc(new_license_document['rights']['end'])
         if convert_time_to_utc(new_end_date) != new_rights_date:
-            return "End date in Rights in license document is difference with End date"
+            return InteractionResult('renew', VERDICT_FAIL, http_code, 'renew_rights_end')
 
         # license: check updated in license old and new
         new_license_updated = convert_time_to_utc(new_license_document['updated'])
         old_license_updated = convert_time_to_utc(old_license_document['updated'])
         if new_license_updated <= old_license_updated \
                 or new_license_updated != new_status_updated:
-            return "License updated timestamp is not updated"
+            return InteractionResult('renew', VERDICT_FAIL, http_code, 'renew_license_updated')
 
-        return "Server response is 200"
+        return InteractionResult('renew', VERDICT_PASS, http_code)
     elif http_code >= 400 or http_code < 600:
-        return "Server response is {}\n{}\n{}".format(str(http_code), response_value['type'], response_value['title'])
+        return _problem_result('renew', http_code, response_value)
     else:
-        return "Unknown response code"
+        return InteractionResult('renew', VERDICT_ERROR, http_code, 'unknown_code')
 
 
-def do_return(license_document, device_id, device_name):
+def do_return(license_document, device_id, device_name, session=None, as_record=False):
     """
     Args:
         license_document (dict): License Document
         device_id (str): Device ID
         device_name (str): Device name
+        session (InteractionSession): Session of the interaction chain. default value: None, a new one
+        as_record (bool): Return the InteractionResult instead of its message. default value: False
 
     Returns:
         str: Message of evaluation result about "request return".
+            InteractionResult when as_record is True.
     """
+    session = session or InteractionSession(license_document, device_id, device_name)
     try:
-        status_document = get_status_document(license_document, device_id, device_name)
+        status_document = session.get_status_document()
 
         # Need to wait for different timestamp between old status document(//updated/status/) and new one(same path)
-        time.sleep(1)
+        return_link = get_link_index(status_document).href('return')
+        time.sleep(get_timestamp_delay(status_document, license_document, connection_pool.server_time(return_link)))
 
+        start = time.perf_counter()
         http_code, result = request_return(status_document, device_id, device_name)
-        json_resp_data = json.loads(result)
+        invalidate_status_cache(license_document)
+        with trace_phase('request_return', 'decode'):
+            json_resp_data = decode_status_document(result)
 
         if 'status' in json_resp_data.keys():
-            new_lic_str = request_license_document(json_resp_data)
-            new_license = json.loads(new_lic_str)
+            new_lic_body = request_license_document(json_resp_data)
+            with trace_phase('request_license_document', 'decode'):
+                new_license = json_loads(new_lic_body)
         else:
             new_license = dict()
 
-        return eval_return_result(http_code, json_resp_data,
-                                  status_document,
-                                  new_license, license_document)
+        session.update(http_code, json_resp_data, new_license)
+        with trace_phase('eval_return_result', 'evaluate'):
+            record = check_return_result(http_code, json_resp_data,
+                                         status_document,
+                                         new_license, license_document)
+        record.elapsed = time.perf_counter() - start
     except Exception as e:
-        return "Function: do_return\nMessage: " + '\n'.join(traceback.format_exception(Exception, e, None))
+        session.status_document = None
+        record = InteractionResult('return', VERDICT_ERROR, check='exception', args=('do_return', format_error(e)))
+    return record if as_record else str(record)
 
 
 def request_return(status_document, device_id, device_name):
@@ -303,17 +1154,24 @@ def request_return(status_document, device_id, device_name):
 
     Returns:
         int: http status code about server response.
-        str: Server response value which is status document or error message.
+        bytes: Server response value which is status document or error message.
     """
-    return_link = generate_query(status_document['links']['return']['href'],
-                                 device_id=device_id, device_name=device_name)
     method = 'PUT'
-    url = urlparse(return_link)
-    conn = http.client.HTTPConnection(url[1])
-    conn.request(method, url[2] + '?' + url[4])
+    return connection_pool.request(method, get_return_link(status_document, device_id, device_name),
+                                   operation='request_return')
 
-    with conn.getresponse() as result:
-        return result.status, result.read().decode()
+
+def get_return_link(status_document, device_id, device_name):
+    """
+    Args:
+        status_document (dict): Status Document
+        device_id (str): Device ID
+        device_name (str): Device name
+
+    Returns:
+        str: Url for "request return".
+    """
+    return get_link_index(status_document).expand('return', {'id': device_id, 'name': device_name})
 
 
 def eval_return_result(http_code, response_value, old_status_document,
@@ -329,6 +1187,19 @@ def eval_return_result(http_code, response_value, old_status_document,
     Returns:
         str: Result message that describe correctly done of process or not, and new license document and status document is correctly renewal.
     """
+    return str(check_return_result(http_code, response_value, old_status_document, new_license_document,
+                                   old_license_document))
+
+
+def check_return_result(http_code, response_value, old_status_document,
+                        new_license_document, old_license_document):
+    """
+    Args:
+        See eval_return_result.
+
+    Returns:
+        InteractionResult: Verdict and failing check of "request return".
+    """
     if http_code == 200:
         # check status in status document
         status_ready_to_cancelled = old_status_document['status'] == 'ready' \
@@ -336,59 +1207,92 @@ def eval_return_result(http_code, response_value, old_status_document,
         status_active_to_returned = old_status_document['status'] == 'active' \
                                     and response_value['status'] == 'returned'
         if not status_active_to_returned ^ status_ready_to_cancelled:
-            return "Status in status document is not valid. before: {} current: {}".format(
-                old_status_document['status'], response_value['status'])
+            return InteractionResult('return', VERDICT_FAIL, http_code, 'return_status',
+                                     (old_status_document['status'], response_value['status']))
 
         # check updated license timestamp in new status and new license
         old_updated_license = convert_time_to_utc(old_license_document['updated'])
         new_updated_license = convert_time_to_utc(new_license_document['updated'])
         new_updated_license_status = convert_time_to_utc(response_value['updated']['license'])
         if old_updated_license >= new_updated_license:
-            return "Timestamp about license updated in lsd is not updated"
+            return InteractionResult('return', VERDICT_FAIL, http_code, 'return_lsd_license_updated')
 
         if new_updated_license != new_updated_license_status:
-            return "Timestamp about license updated in lcp is not updated"
+            return InteractionResult('return', VERDICT_FAIL, http_code, 'return_lcp_license_updated')
 
         # check updated status timestamp in old status and new status
         old_updated_status_status = convert_time_to_utc(old_status_document['updated']['status'])
         new_updated_status_status = convert_time_to_utc(response_value['updated']['status'])
         if old_updated_status_status >= new_updated_status_status:
-            return "Timestamp about status updated is not updated"
+            return InteractionResult('return', VERDICT_FAIL, http_code, 'return_status_updated')
 
-        return "Server response is 200"
+        return InteractionResult('return', VERDICT_PASS, http_code)
     elif http_code >= 400 or http_code < 600:
-        return "Server response is {} \n{} \n{}".format(str(http_code), response_value['type'], response_value['title'])
+        return _problem_result('return', http_code, response_value, 'return_server_error')
     else:
-        return "Unknown response code"
+        return InteractionResult('return', VERDICT_ERROR, http_code, 'unknown_code')
+
+
+def get_timestamp_delay(status_document, license_document=None, server_time=None):
+    """
+    Args:
+        status_document (dict): Status Document before the interaction.
+        license_document (dict): License Document before the interaction. default value: None
+        server_time (datetime): Lower bound of the server clock, see ConnectionPool.server_time. default value: None
+
+    Returns:
+        float: Seconds to wait until the next second boundary after the latest updated timestamp of the documents,
+               so that the server can not stamp the new documents with the same second. 0 when it already passed.
+               The client clock is not used, it may run ahead of the server clock.
+    """
+    timestamps = [status_document['updated']['status'], status_document['updated']['license']]
+    if license_document is not None and 'updated' in license_document:
+        timestamps.append(license_document['updated'])
+
+    latest = max(convert_time_to_utc(timestamp) for timestamp in timestamps)
+    next_boundary = latest.replace(microsecond=0) + timedelta(seconds=1)
+    # the server clock passed the latest timestamp already, and the Date of its responses when one is known
+    server_now = latest if server_time is None else max(latest, server_time)
+    return max(0.0, (next_boundary - server_now).total_seconds())
+
 
+# RFC 3339 date-time: date, time, optional fraction of second and Z or numeric offset (colon is optional)
+_DATETIME_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?([Zz]|[+-]\d{2}:?\d{2})\Z')
 
+
+@functools.lru_cache(maxsize=4096)
 def convert_time_to_utc(time_in_timezone):
     """
     Args:
-        time_in_timezone (str): datetime in ISO 8601 format
+        time_in_timezone (str): datetime in ISO 8601(RFC 3339) format
 
     Returns:
-        datetime: Converted datetime with timezone in UTC.
+        datetime: Converted datetime with timezone in UTC. Results are cached by the string.
+
+    Raises:
+        ValueError: time_in_timezone is not RFC 3339 datetime.
     """
-    if time_in_timezone.find('Z') > 0:
-        return datetime.strptime(time_in_timezone, "%Y-%m-%dT%H:%M:%SZ")
-    else:
-        tz_loc = time_in_timezone.find('+')
-        if tz_loc == -1:
-            tz_loc = time_in_timezone.find('-')
-        new_time = datetime.strptime(time_in_timezone[:tz_loc], "%Y-%m-%dT%H:%M:%S")
-        tz_delta = timedelta(hours=int(time_in_timezone[tz_loc + 1:tz_loc + 3]),
-                             minutes=int(time_in_timezone[-2:]))
-        if time_in_timezone[tz_loc] == '-':
-            return new_time + tz_delta
-        elif time_in_timezone[tz_loc] == '+':
-            return new_time - tz_delta
+    match = _DATETIME_PATTERN.match(time_in_timezone)
+    if match is None:
+        raise ValueError("Invalid datetime: {}".format(time_in_timezone))
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    utc_time = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                        int(fraction[:6].ljust(6, '0')) if fraction else 0, utc)
+    if offset in ('Z', 'z'):
+        return utc_time
+
+    tz_delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:]))
+    if offset[0] == '-':
+        return utc_time + tz_delta
+    return utc_time - tz_delta
 
 
 def parse_arguments():
     """
     Returns:
-        dict: System argument values -- epub_file, dev_id, instruction, end_date.
+        dict: System argument values -- epub_file, dev_id, dev_name, instruction, end_date, schema, license_cache, metrics,
+            record, replay, replay_speed, event_sample.
     """
 
     env = dict()
@@ -403,10 +1307,188 @@ def parse_arguments():
             env['end_date'] = sys.argv[idx + 1]
         elif sys.argv[idx] == '-n':
             env['dev_name'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-s':
+            env['schema'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-l':
+            env['license_cache'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-x':
+            env['metrics'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-R':
+            env['record'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-P':
+            env['replay'] = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-S':
+            env['replay_speed'] = float(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-E':
+            env['event_sample'] = int(sys.argv[idx + 1])
 
     return env
 
 
+LICENSE_ENTRY = 'META-INF/license.lcpl'
+LICENSE_MEDIA_TYPE = 'application/vnd.readium.lcp.license-1.0+json'
+
+
+def read_zip_entry(path, entry_name):
+    """
+    Args:
+        path (str): Path of zip file.
+        entry_name (str): Name of entry in zip file.
+
+    Returns:
+        bytes: Uncompressed data of the entry. Only the end of central directory, the central directory
+               and the entry are read; zip64, encrypted or unusual archives fall back to ZipFile.
+    """
+    with open(path, 'rb') as zip_file:
+        zip_file.seek(0, os.SEEK_END)
+        file_size = zip_file.tell()
+        zip_file.seek(max(0, file_size - 65557))
+        tail = zip_file.read()
+
+        eocd = tail.rfind(b'PK\x05\x06')
+        if eocd < 0 or len(tail) - eocd < 22:
+            return _read_zip_entry_fallback(path, entry_name)
+        entries, cd_size, cd_offset = struct.unpack('<10xHII', tail[eocd:eocd + 20])
+        if entries == 0xFFFF or cd_offset == 0xFFFFFFFF or cd_offset + cd_size > file_size:
+            return _read_zip_entry_fallback(path, entry_name)
+
+        zip_file.seek(cd_offset)
+        central_directory = zip_file.read(cd_size)
+        name = entry_name.encode('utf-8')
+        pos = 0
+        while central_directory[pos:pos + 4] == b'PK\x01\x02':
+            flags, method, crc, compressed_size, name_len, extra_len, comment_len, local_offset = \
+                struct.unpack('<8xHH4xII4xHHH8xI', central_directory[pos:pos + 46])
+            if central_directory[pos + 46:pos + 46 + name_len] == name:
+                break
+            pos += 46 + name_len + extra_len + comment_len
+        else:
+            if pos != len(central_directory):
+                # data before the zip start (e.g. a self-extracting stub) moves every offset, ZipFile corrects them
+                return _read_zip_entry_fallback(path, entry_name)
+            raise KeyError("There is no item named {!r} in the archive".format(entry_name))
+
+        if flags & 0x1 or method not in (0, 8) or compressed_size == 0xFFFFFFFF:
+            return _read_zip_entry_fallback(path, entry_name)
+        zip_file.seek(local_offset)
+        local_header = zip_file.read(30)
+        if local_header[:4] != b'PK\x03\x04':
+            return _read_zip_entry_fallback(path, entry_name)
+        zip_file.seek(local_offset + 30 + sum(struct.unpack('<HH', local_header[26:30])))
+        data = zip_file.read(compressed_size)
+
+    if method == 8:
+        data = zlib.decompress(data, -15)
+    if zlib.crc32(data) & 0xFFFFFFFF != crc:
+        raise ValueError("Bad CRC-32 for file {!r}".format(entry_name))
+    return data
+
+
+def _read_zip_entry_fallback(path, entry_name):
+    with importlib.import_module('zipfile').ZipFile(path) as zf:
+        return zf.read(entry_name)
+
+
+def read_license_document(path):
+    """
+    Args:
+        path (str): Path of Epub file that has License Document(license.lcpl).
+
+    Returns:
+        dict: License Document from epub file.
+    """
+    return json_loads(read_zip_entry(path, LICENSE_ENTRY))
+
+
+class LicenseCache(object):
+    """
+    License Documents extracted from epub files, persisted in a json index file and keyed by path, mtime and size,
+    so that unchanged epub files are never opened again.
+    """
+
+    def __init__(self, index_file):
+        """
+        Args:
+            index_file (str): Path of json index file, created by save when it does not exist.
+        """
+        self.index_file = index_file
+        self._entries = dict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        if os.path.exists(index_file):
+            with open(index_file) as index:
+                self._entries = json.loads(index.read())
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, path):
+        """
+        Args:
+            path (str): Path of Epub file.
+
+        Returns:
+            dict: Cached License Document, None when the file is unknown or changed.
+        """
+        abs_path, mtime, size = self._key(path)
+        entry = self._entries.get(abs_path)
+        if entry is not None and entry['mtime'] == mtime and entry['size'] == size:
+            return entry['license']
+        return None
+
+    def put(self, path, license_document):
+        """
+        Args:
+            path (str): Path of Epub file.
+            license_document (dict): License Document extracted from the file.
+        """
+        abs_path, mtime, size = self._key(path)
+        with self._lock:
+            self._entries[abs_path] = {'mtime': mtime, 'size': size, 'license': license_document}
+            self._dirty = True
+
+    def get_license_document(self, path):
+        """
+        Args:
+            path (str): Path of Epub file.
+
+        Returns:
+            dict: License Document, extracted and cached when it is not in the cache.
+        """
+        license_document = self.get(path)
+        if license_document is None:
+            license_document = read_license_document(path)
+            self.put(path, license_document)
+        return license_document
+
+    def save(self):
+        """
+        Write the index file when something was added.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'w') as index:
+                index.write(json.dumps(self._entries))
+            os.replace(tmp_file, self.index_file)
+            self._dirty = False
+
+
+license_cache = None
+
+
+def set_license_cache(index_file):
+    """
+    Args:
+        index_file (str): Path of json index file used by get_license_document from now on, None to disable the cache.
+    """
+    global license_cache
+    license_cache = LicenseCache(index_file) if index_file else None
+
+
 def get_license_document(epub_file_name):
     """
     Args:
@@ -417,12 +1499,150 @@ def get_license_document(epub_file_name):
     """
     try:
         path = os.path.join(os.getcwd(), epub_file_name)
-        with ZipFile(path) as zf:
-            with zf.open('META-INF/license.lcpl') as license_document:
-                return json.loads(license_document.read().decode(encoding='utf-8'))
+        if license_cache is not None:
+            return license_cache.get_license_document(path)
+        return read_license_document(path)
     except Exception as e:
         return {"Function": "get_license_document",
-                "Message": '\n'.join(traceback.format_exception(Exception, e, None))}
+                "Message": format_error(e)}
+
+
+class StatusCache(object):
+    """
+    Status Documents by url in a bounded LRU, revalidated with If-None-Match/If-Modified-Since and
+    kept fresh for Cache-Control max-age. Cached documents are shared, callers must not modify them.
+    """
+
+    def __init__(self, max_entries=1024):
+        """
+        Args:
+            max_entries (int): Max number of cached Status Documents. default value: 1024
+        """
+        self.max_entries = max_entries
+        self.stats = {'fresh': 0, 'not_modified': 0, 'fetched': 0}
+        self._entries = collections.OrderedDict()
+        self._validations = dict()
+        self._lock = threading.Lock()
+
+    def fetch(self, url, operation='get_status_document'):
+        """
+        Args:
+            url (str): Url of Status Document.
+            operation (str): Name of calling function for tracing. default value: 'get_status_document'
+
+        Returns:
+            dict: Status Document, the cached one when it is fresh or the server answered 304.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+                if entry['expires'] > time.monotonic():
+                    self.stats['fresh'] += 1
+                    return entry['document']
+
+        headers = dict()
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        status, response_headers, body = connection_pool.send('GET', url, headers, operation)
+        if status == 304 and entry is not None:
+            with self._lock:
+                self.stats['not_modified'] += 1
+                entry['expires'] = self._expires(response_headers)
+            return entry['document']
+
+        with self._lock:
+            self.stats['fetched'] += 1
+        with trace_phase(operation, 'decode'):
+            document = decode_status_document(body)
+        cache_control = (response_headers.get('Cache-Control') or '').lower()
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if status == 200 and 'no-store' not in cache_control and (etag or last_modified or 'max-age' in cache_control):
+            self._store(url, {'document': document, 'etag': etag, 'last_modified': last_modified,
+                              'expires': self._expires(response_headers)})
+        else:
+            self.invalidate(url)
+        return document
+
+    @staticmethod
+    def _expires(response_headers):
+        cache_control = (response_headers.get('Cache-Control') or '').lower()
+        if 'no-cache' in cache_control:
+            return 0.0
+        match = re.search(r'max-age=(\d+)', cache_control)
+        return time.monotonic() + int(match.group(1)) if match else 0.0
+
+    def _store(self, url, entry):
+        with self._lock:
+            old_entry = self._entries.pop(url, None)
+            if old_entry is not None:
+                self._validations.pop(id(old_entry['document']), None)
+            self._entries[url] = entry
+            # only documents held by the cache have validations, so id() can not be reused meanwhile
+            self._validations[id(entry['document'])] = dict()
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._validations.pop(id(evicted['document']), None)
+
+    def invalidate(self, url_prefix):
+        """
+        Args:
+            url_prefix (str): Every cached url starting with it is removed, e.g. status link of a license.
+        """
+        with self._lock:
+            for url in [url for url in self._entries if url.startswith(url_prefix)]:
+                self._validations.pop(id(self._entries.pop(url)['document']), None)
+
+    def get_validation(self, status_document, schema_file):
+        """
+        Args:
+            status_document (dict): Status Document.
+            schema_file (str): Path of json schema file.
+
+        Returns:
+            tuple: Result of fetch_status when the cached document was already validated against the schema, else None.
+        """
+        return self._validations.get(id(status_document), dict()).get(schema_file)
+
+    def set_validation(self, status_document, schema_file, result):
+        """
+        Args:
+            status_document (dict): Status Document.
+            schema_file (str): Path of json schema file.
+            result (tuple): Result of fetch_status.
+        """
+        with self._lock:
+            validations = self._validations.get(id(status_document))
+            if validations is not None:
+                validations[schema_file] = result
+
+
+status_cache = None
+
+
+def set_status_cache(max_entries=1024):
+    """
+    Args:
+        max_entries (int): Max number of Status Documents cached by get_status_document from now on,
+            0 or None to disable the cache. default value: 1024
+    """
+    global status_cache
+    status_cache = StatusCache(max_entries) if max_entries else None
+
+
+def invalidate_status_cache(license_document):
+    """
+    Args:
+        license_document (dict): License Document whose cached Status Documents are dropped after an interaction.
+    """
+    if status_cache is not None:
+        # cached urls start with the status href, up to its template expressions
+        status_cache.invalidate(get_link_index(license_document).href('status').split('{', 1)[0])
 
 
 def get_status_document(license_document, device_id, device_name):
@@ -435,42 +1655,324 @@ def get_status_document(license_document, device_id, device_name):
     Returns:
         dict: Status document fetched from server.
     """
-    status_link = license_document['links']['status']['href']
-    status_link = status_link + "?id=" + device_id + "&name=" + device_name
-
-    url = urlparse(status_link)
-    req_path = url[2] + '?' + url[4]
-
     try:
+        status_link = get_status_link(license_document, device_id, device_name)
+        if status_cache is not None:
+            return status_cache.fetch(status_link)
         method = 'GET'
-        conn = http.client.HTTPConnection(url[1])
-        conn.request(method, req_path)
-
-        with conn.getresponse() as result:
-            return json.loads(result.read().decode())
+        _, body = connection_pool.request(method, status_link, operation='get_status_document')
+        with trace_phase('get_status_document', 'decode'):
+            return decode_status_document(body)
     except Exception as e:
         return {"Function": "get_status_document",
-                "Message": '\n'.join(traceback.format_exception(Exception, e, None))}
+                "Message": format_error(e)}
+
+
+def get_status_link(license_document, device_id, device_name):
+    """
+    Args:
+        license_document (dict): License document with link url for status document.
+        device_id (str): Device ID
+        device_name (str): Device name
+
+    Returns:
+        str: Url for status document of the device.
+    """
+    status_link = get_link_index(license_document).get('status')
+    template = status_link['href']
+    if not status_link.get('templated') or '{' not in template:
+        template += '{&id,name}' if '?' in template else '{?id,name}'
+    return expand_uri_template(template, {'id': device_id, 'name': device_name})
+
+
+def set_status_schema(schema):
+    """
+    Args:
+        schema (str): 'new', 'old' or path of a json schema file, used by fetch_status from now on.
+    """
+    global status_schema_file
+    status_schema_file = STATUS_SCHEMA_FILES.get(schema, schema)
 
 
-def fetch_status(status_document):
-    # TODO: If you want to follow old lsd specification, you should use "old_json_schema_lsd.json" when call open function.
+def get_status_validator(schema_file=None):
+    """
+    Args:
+        schema_file (str): Path of json schema file. default value: None, the file chosen by set_status_schema.
+            A relative path is looked up in the current directory, then next to this script.
+
+    Returns:
+        jsonschema validator: Validator of the schema, built once per process and per file.
+    """
+    schema_file = schema_file or status_schema_file
+    validator = _status_validators.get(schema_file)
+    if validator is not None:
+        return validator
+
+    with _status_validators_lock:
+        if schema_file not in _status_validators:
+            path = schema_file
+            if not os.path.isabs(path) and not os.path.exists(path):
+                path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+            with open(path) as schema_file_object:
+                json_schema = json.loads(schema_file_object.read())
+            validator_class = import_dependency('jsonschema').validators.validator_for(json_schema)
+            validator_class.check_schema(json_schema)
+            _status_validators[schema_file] = validator_class(json_schema)
+        return _status_validators[schema_file]
+
+
+def fetch_status(status_document, schema_file=None):
     """
     Args:
         status_document (dict): Dictionary object of status document.
+        schema_file (str): Path of json schema file. default value: None, the file chosen by set_status_schema.
 
     Returns:
         str: Result message of syntax check.
         bool: True or False by check result.
     """
-    try:
-        with open('json_schema_lsd.json') as schema_file:
-            json_schema = json.loads(schema_file.read())
-            json_validate(status_document, json_schema)
+    schema_file = schema_file or status_schema_file
+    if status_cache is not None:
+        # a document revalidated with 304 was already checked
+        result = status_cache.get_validation(status_document, schema_file)
+        if result is not None:
+            return result
+
+    validator = get_status_validator(schema_file)
+    with trace_phase('fetch_status', 'validate'):
+        valid = validator.is_valid(status_document)
+    result = ('Syntax is correct.', True) if valid else ('Syntax is invalid.', False)
+    if status_cache is not None:
+        status_cache.set_validation(status_document, schema_file, result)
+    return result
+
+
+def validate_status_documents(status_documents, schema_file=None):
+    """
+    Args:
+        status_documents (iterable): Dictionary objects of status documents.
+        schema_file (str): Path of json schema file. default value: None, the file chosen by set_status_schema.
+
+    Returns:
+        list: Every validation error message of each status document, an empty list for a valid one.
+    """
+    validator = get_status_validator(schema_file)
+    return [['/' + '/'.join(str(part) for part in error.absolute_path) + ': ' + error.message
+             for error in validator.iter_errors(status_document)]
+            for status_document in status_documents]
+
+
+# RFC 6570 operators -- first, separator, named, string for empty named values, reserved characters allowed
+_URI_TEMPLATE_OPERATORS = {'': ('', ',', False, '', False),
+                           '+': ('', ',', False, '', True),
+                           '#': ('#', ',', False, '', True),
+                           '.': ('.', '.', False, '', False),
+                           '/': ('/', '/', False, '', False),
+                           ';': (';', ';', True, '', False),
+                           '?': ('?', '&', True, '=', False),
+                           '&': ('&', '&', True, '=', False)}
+_URI_TEMPLATE_EXPRESSION = re.compile(r'{([^{}]*)}')
+_URI_TEMPLATE_VARIABLE = re.compile(r'(?:[A-Za-z0-9_]|%[0-9A-Fa-f]{2})(?:\.?(?:[A-Za-z0-9_]|%[0-9A-Fa-f]{2}))*\Z')
+_URI_RESERVED = ":/?#[]@!$&'()*+,;="
+_PCT_ENCODED = re.compile(r'(%[0-9A-Fa-f]{2})')
+
+
+# encoded values by (value, allow_reserved), device ids, names and end dates repeat over many requests
+_encoded_uri_values = dict()
+
+
+def _encode_uri_value(value, allow_reserved):
+    encoded = _encoded_uri_values.get((value, allow_reserved))
+    if encoded is not None:
+        return encoded
+    if not allow_reserved:
+        encoded = quote(value, safe='')
+    else:
+        # pct-encoded triplets are kept as they are in reserved expansion
+        encoded = ''.join(part if _PCT_ENCODED.match(part) else quote(part, safe=_URI_RESERVED)
+                          for part in _PCT_ENCODED.split(value))
+    if len(_encoded_uri_values) >= 4096:
+        _encoded_uri_values.clear()
+    _encoded_uri_values[(value, allow_reserved)] = encoded
+    return encoded
+
+
+class UriTemplate(object):
+    """
+    URI template of RFC 6570 up to level 3, parsed once into literals and expressions.
+    """
+    __slots__ = ('template', '_parts')
+
+    def __init__(self, template):
+        """
+        Args:
+            template (str): URI template, e.g. <scheme>://<host>/<path>{?id,name}
+
+        Raises:
+            ValueError: An expression is empty or has a level 4 modifier.
+        """
+        self.template = template
+        # literals are str, expressions are (first, separator, allow_reserved, ((name, prefix, empty), ...))
+        self._parts = list()
+        position = 0
+        for match in _URI_TEMPLATE_EXPRESSION.finditer(template):
+            if match.start() > position:
+                self._parts.append(template[position:match.start()])
+            expression = match.group(1)
+            operator = expression[:1] if expression[:1] in '+#./;?&' else ''
+            names = expression[len(operator):].split(',')
+            if not expression or not all(_URI_TEMPLATE_VARIABLE.match(name) for name in names):
+                raise ValueError("Unsupported expression in URI template: {{{}}}".format(expression))
+            first, separator, named, if_empty, allow_reserved = _URI_TEMPLATE_OPERATORS[operator]
+            variables = tuple((name, name + '=' if named else '', name + if_empty if named else '')
+                              for name in names)
+            self._parts.append((first, separator, allow_reserved, variables))
+            position = match.end()
+        if position < len(template):
+            self._parts.append(template[position:])
+
+    def expand(self, variables):
+        """
+        Args:
+            variables (dict): Value of each variable, str. Variables missing or None are undefined and left out.
+
+        Returns:
+            str: Expanded URI, values percent-encoded.
+        """
+        uri = ''
+        for part in self._parts:
+            if part.__class__ is str:
+                uri += part
+                continue
+            first, separator, allow_reserved, names = part
+            for name, prefix, empty in names:
+                value = variables.get(name)
+                if value is None:
+                    continue
+                value = _encode_uri_value(value if value.__class__ is str else str(value), allow_reserved)
+                uri += first + (prefix + value if value else empty)
+                first = separator
+        return uri
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_uri_template(template):
+    """
+    Args:
+        template (str): URI template.
+
+    Returns:
+        UriTemplate: Parsed template, cached per template string.
+    """
+    return UriTemplate(template)
+
+
+def expand_uri_template(template, variables):
+    """
+    Args:
+        template (str): URI template, e.g. <scheme>://<host>/<path>{?id,name}
+        variables (dict): Value of each variable, None for undefined ones.
+
+    Returns:
+        str: Expanded URI.
+    """
+    return compile_uri_template(template).expand(variables)
+
+
+class LinkIndex(object):
+    """
+    Links of a License or Status Document by rel, for links given as an object of rels (old specification)
+    or as an array of link objects with rel (LSD 1.0).
+    """
+    __slots__ = ('_links', '_templates')
+
+    def __init__(self, links):
+        """
+        Args:
+            links (dict or list): links member of the document.
+        """
+        self._links = dict()
+        self._templates = dict()
+        if isinstance(links, dict):
+            for rel, link in links.items():
+                self._links[rel] = list(link) if isinstance(link, list) else [link]
+        else:
+            for link in links:
+                rels = link.get('rel', [])
+                for rel in (rels if isinstance(rels, list) else [rels]):
+                    self._links.setdefault(rel, list()).append(link)
+
+    def get(self, rel, media_type=None):
+        """
+        Args:
+            rel (str): Relation, e.g. renew.
+            media_type (str): Only a link of this type. default value: None, the first link of the rel
+
+        Returns:
+            dict: Link object.
+
+        Raises:
+            KeyError: The document has no such link.
+        """
+        for link in self._links.get(rel, ()):
+            if media_type is None or link.get('type') == media_type:
+                return link
+        raise KeyError("No {} link{}".format(rel, '' if media_type is None else ' of type ' + media_type))
+
+    def href(self, rel, media_type=None):
+        """
+        Args:
+            rel (str): Relation.
+            media_type (str): Only a link of this type. default value: None
+
+        Returns:
+            str: href of the link, as it is in the document.
+        """
+        return self.get(rel, media_type)['href']
+
+    def expand(self, rel, variables, media_type=None):
+        """
+        Args:
+            rel (str): Relation.
+            variables (dict): Values of the template variables, None for undefined ones.
+            media_type (str): Only a link of this type. default value: None
+
+        Returns:
+            str: Url of the link, its href expanded as a URI template.
+        """
+        key = (rel, media_type)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = compile_uri_template(self.href(rel, media_type))
+        return template.expand(variables)
+
+
+_link_indexes = collections.OrderedDict()
+_link_indexes_lock = threading.Lock()
+
+
+def get_link_index(document, max_entries=1024):
+    """
+    Args:
+        document (dict): License or Status Document.
+        max_entries (int): Max number of links objects whose index is kept, the oldest are dropped. default value: 1024
+
+    Returns:
+        LinkIndex: Index of the links of the document, built once per links object.
+    """
+    # only the links member is kept with its index, not the document whose events may be large.
+    # keeping it means its id is not reused while the entry exists
+    links = document['links']
+    entry = _link_indexes.get(id(links))
+    if entry is not None and entry[0] is links:
+        return entry[1]
 
-            return 'Syntax is correct.', True
-    except exceptions.ValidationError:
-        return 'Syntax is invalid.', False
+    index = LinkIndex(links)
+    with _link_indexes_lock:
+        _link_indexes[id(links)] = (links, index)
+        while len(_link_indexes) > max_entries:
+            _link_indexes.popitem(last=False)
+    return index
 
 
 def generate_query(template_url, device_id=None, device_name=None, end_date=None):
@@ -482,27 +1984,74 @@ def generate_query(template_url, device_id=None, device_name=None, end_date=None
         end_date (str): Newly license expired date. It is optional. default value: None
 
     Returns:
-        str: Url string. (e.g. <scheme>://<host>/<path>?id=device_id,name=device_name)
+        str: Url string with percent-encoded values. (e.g. <scheme>://<host>/<path>?id=device_id&name=device_name)
     """
-    low_idx = template_url.find('{')
-    high_idx = template_url.find('}')
-    template_query = template_url[low_idx:high_idx + 1]
+    return expand_uri_template(template_url, {'id': device_id, 'name': device_name, 'end': end_date})
 
-    query_str = str()
-    if template_query[1] == '?':
-        query_str += '?'
-    keys = template_query[2:-1].split(',')
-    for key in keys:
-        if key == 'id' and device_id is not None:
-            query_str += 'id=' + device_id + '&'
-        elif key == 'name' and device_name is not None:
-            query_str += 'name=' + device_name + '&'
-        elif key == 'end' and end_date is not None:
-            query_str += 'end=' + end_date + '&'
 
-    if len(query_str) == 1:
-        query_str = ""
-    return template_url.replace(template_query, query_str[:-1])
+def run_interaction(epub_file, instruction, device_id, device_name, end_date=None, details=None):
+    """
+    Args:
+        epub_file (str): Name or path of Epub file that has License Document(license.lcpl).
+        instruction (str): Interaction name [fetch|fetch_license|register|renew|return]
+        device_id (str): Device ID
+        device_name (str): Device name
+        end_date (str): ISO8601 end date for "request renew". default value: None
+        details (dict): When given, receives http_code of the last interaction request (None when none was sent)
+            and records, the InteractionResult of every register, renew and return of the chain.
+
+    Returns:
+        str: Result message of the interaction, or None when instruction is unknown.
+        dict: Fetched document for "fetch" and "fetch_license", otherwise None.
+    """
+    license_document = get_license_document(epub_file)
+    if 'Function' in license_document.keys():
+        return 'Function: {}\nMessage: {}'.format(license_document['Function'], license_document['Message']), None
+    status_document = get_status_document(license_document, device_id, device_name)
+    if 'Function' in status_document.keys():
+        return 'Function: {}\nMessage: {}'.format(status_document['Function'], status_document['Message']), None
+    if 'title' in status_document.keys():
+        return 'Type: {}\nTitle: {}'.format(status_document['type'], status_document['title']), None
+
+    res, valid = fetch_status(status_document)
+    document = None
+    # carries the status document through the chain instead of fetching it before every interaction
+    session = InteractionSession(license_document, device_id, device_name, status_document)
+
+    records = list()
+    if instruction == 'register':
+        if valid:
+            records.append(do_register(license_document, device_id, device_name, session, as_record=True))
+            res += '\n' + str(records[-1])
+    elif instruction == 'renew':
+        if valid:
+            records.append(do_register(license_document, device_id, device_name, session, as_record=True))
+            records.append(do_renew(license_document, end_date, device_id, device_name, session, as_record=True))
+            res += '\nregister: {}\n{}'.format(*records)
+    elif instruction == 'return':
+        if valid:
+            records.append(do_register(license_document, device_id, device_name, session, as_record=True))
+            records.append(do_return(license_document, device_id, device_name, session, as_record=True))
+            res += '\nregister: {}\n{}'.format(*records)
+    elif instruction == 'fetch_license':
+        if valid:
+            body = request_license_document(status_document)
+            if isinstance(body, tuple):
+                res += '\n' + body[0]
+            else:
+                with trace_phase('request_license_document', 'decode'):
+                    document = json_loads(body)
+    elif instruction == 'fetch':
+        if valid:
+            document = status_document
+            res += '\nStatus is ' + status_document['status']
+    else:
+        return None, None
+
+    if details is not None:
+        details['http_code'] = session.http_code
+        details['records'] = records
+    return res, document
 
 
 def main():
@@ -517,52 +2066,55 @@ def main():
         print("-d Device id")
         print("-n Device name")
         print("-e ISO8601 end date")
+        print("-s Status document schema [new|old|schema file] (default: new)")
+        print("-l License cache index file")
+        print("-x Phase metrics file, Prometheus text for .prom and json otherwise")
+        print("-R Record every request and response into this archive file")
+        print("-P Replay responses from this archive file instead of the server")
+        print("-S Replay speed, recorded latency is divided by it, 0 for none (default: 1)")
+        print("-E Max number of events of Status Documents kept and validated, sampled (default: all)")
 
     args = parse_arguments()
-
-    if len(args) is not 4 and len(args) is not 5:
+    if 'schema' in args:
+        set_status_schema(args.pop('schema'))
+    if 'license_cache' in args:
+        set_license_cache(args.pop('license_cache'))
+    metrics_file = args.pop('metrics', None)
+    if metrics_file is not None:
+        set_tracer(PhaseTracer())
+    if 'event_sample' in args:
+        set_status_event_sample(args.pop('event_sample'))
+    traffic = {key: args.pop(key) for key in ('record', 'replay', 'replay_speed') if key in args}
+    recorder = importlib.import_module('lsd_replay').configure_traffic(traffic) if traffic else None
+
+    if len(args) != 4 and len(args) != 5:
         usage()
         exit()
 
-    license_document = get_license_document(args["epub_file"])
-    if 'Function' in license_document.keys():
-        print('Function: {}'.format(license_document['Function']))
-        print('Message: {}'.format(license_document['Message']))
-        exit()
-    status_document = get_status_document(license_document, args["dev_id"], args["dev_name"])
-    if 'title' in status_document.keys():
-        print('Type: {}'.format(status_document['type']))
-        print('Title: {}'.format(status_document['title']))
-        exit()
-
-    res, valid = fetch_status(status_document)
-
-    if args["instruction"] == 'register':
-        if valid:
-            res += '\n' + do_register(license_document, args["dev_id"], args["dev_name"])
-    elif args["instruction"] == 'renew':
-        if valid:
-            res += '\nregister: ' + do_register(license_document, args["dev_id"], args["dev_name"])
-            res += '\n' + do_renew(license_document, args["end_date"], args["dev_id"], args["dev_name"])
-    elif args["instruction"] == 'return':
-        if valid:
-            res += '\nregister: ' + do_register(license_document, args["dev_id"], args["dev_name"])
-            res += '\n' + do_return(license_document, args["dev_id"], args["dev_name"])
-    elif args["instruction"] == 'fetch_license':
-        if valid:
-            l = request_license_document(status_document)
-            print(json.dumps(l, indent=4))
-    elif args["instruction"] == 'fetch':
-        if valid:
-            print(json.dumps(status_document, indent=4))
-            res += '\nStatus is ' + status_document['status']
-    else:
-        res = ""
+    res, document = run_interaction(args["epub_file"], args.get("instruction"), args.get("dev_id"),
+                                    args.get("dev_name"), args.get("end_date"))
+    if res is None:
         usage()
+        res = ""
+    if document is not None:
+        print(json.dumps(document, indent=4))
 
-    print(Fore.GREEN + res)
+    if license_cache is not None:
+        license_cache.save()
+    if metrics_file is not None:
+        tracer.export(metrics_file)
+    if recorder is not None:
+        recorder.finish()
+
+    try:
+        colorama = importlib.import_module('colorama')
+        colorama.init()
+        print(colorama.Fore.GREEN + res)
+    except ImportError:
+        print(res)
 
 
 if __name__ == "__main__":
-    init()
+    # modules importing lsd_client (lsd_replay) must share the connection pool and settings of this run
+    sys.modules.setdefault('lsd_client', sys.modules[__name__])
     main()
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Load Test for LSD server
+File Name: lsd_load.py
+Files: lsd_load.py(Script file for load test), lsd_client.py(Links and evaluation of every interaction)
+Detail: This script drives many simulated devices against LSD servers with asyncio and reports latency and error rate of each interaction.
+        Every response is still checked by the eval_*_result functions of lsd_client.py.
+    Usage
+     $ python lsd_load.py -i %interaction_name -d %device_id_prefix -n %device_name_prefix -e %end_date -c %devices -r %rate -k %concurrency -o %report_file $source
+       %interaction_name : register, renew or return. renew and return register the device first like lsd_client.py
+                           fan_out registers every device to the first license, then returns it from every registered
+                           device, and checks the events of the Status Document against the accepted requests
+       %device_id_prefix : prefix of device id, each device gets "<prefix>-<number>". default value: device
+       %device_name_prefix : prefix of device name. default value: device
+       %end_date : expired date (renew only)
+       %devices : number of simulated devices. default value: 10
+       %rate : interactions started per second, fan_out starts all at once. default value: 10
+       %concurrency : max number of interactions in flight. default value: 100
+       %report_file : write the report to this file instead of stdout
+       %source : epub file, directory, glob pattern or manifest file (see lsd_batch.py). devices are spread over the licenses
+"""
+
+import asyncio
+import json
+import ssl
+import sys
+import time
+
+from collections import Counter
+from urllib.parse import urlparse
+
+import lsd_batch
+import lsd_client
+
+# lower bound of the clock of every server, from the Date headers of the responses of async_request
+server_clock = lsd_client.ServerClock()
+
+
+async def async_request(method, url, timeout=30):
+    """
+    Args:
+        method (str): Http method.
+        url (str): Absolute url, http or https.
+        timeout (float): Timeout in seconds for the whole request. default value: 30
+
+    Returns:
+        int: Http status code for server response.
+        bytes: Response body.
+    """
+    return await asyncio.wait_for(_async_request(method, url), timeout)
+
+
+async def _async_request(method, url):
+    url = urlparse(url)
+    ssl_context = ssl.create_default_context() if url.scheme == 'https' else None
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+
+    reader, writer = await asyncio.open_connection(url.hostname, port, ssl=ssl_context)
+    try:
+        writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+                     .format(method, path, url.netloc).encode('latin-1'))
+
+        status = int((await reader.readline()).split()[1])
+        received = time.monotonic()
+        headers = dict()
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        server_clock.observe(url.geturl(), headers.get('date'), received)
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    break
+                body += await reader.readexactly(size)
+                await reader.readline()
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+
+        return status, bytes(body)
+    finally:
+        writer.close()
+
+
+async def async_get_status_document(license_document, device_id, device_name):
+    """
+    Args:
+        license_document (dict): License document with link url for status document.
+        device_id (str): Device ID
+        device_name (str): Device name
+
+    Returns:
+        dict: Status document fetched from server.
+    """
+    _, body = await async_request('GET', lsd_client.get_status_link(license_document, device_id, device_name))
+    return lsd_client.json_loads(body)
+
+
+async def async_session_status_document(session):
+    """
+    Args:
+        session (lsd_client.InteractionSession): Session of the interaction chain.
+
+    Returns:
+        dict: Latest Status Document of the session, fetched from server only when it is not known.
+    """
+    if session.status_document is None:
+        session.status_document = await async_get_status_document(session.license_document, session.device_id,
+                                                                  session.device_name)
+    return session.status_document
+
+
+async def async_request_license_document(status_document):
+    """
+    Args:
+        status_document (dict): A LSD with link url for License Document
+
+    Returns:
+        bytes: License Document that received from server.
+    """
+    _, body = await async_request('GET', lsd_client.get_link_index(status_document).href('license'))
+    return body
+
+
+async def async_do_register(license_document, device_id, device_name, session=None, timing=None):
+    """
+    Args:
+        license_document (dict): A License Document with link url for LSD.
+        device_id (str): Device ID
+        device_name (str): Device name
+        session (lsd_client.InteractionSession): Session of the interaction chain. default value: None, a new one
+        timing (dict): When given, receives start, time.perf_counter() before the register request. default value: None
+
+    Returns:
+        str: Result message for "request register" interaction, same as lsd_client.do_register.
+    """
+    session = session or lsd_client.InteractionSession(license_document, device_id, device_name)
+    try:
+        status_document = await async_session_status_document(session)
+        if status_document['status'] != 'ready':
+            return "do_register: This epub file status is {}".format(status_document['status'])
+
+        if timing is not None:
+            timing['start'] = time.perf_counter()
+        code, response_data = await async_request(
+            'POST', lsd_client.get_register_link(status_document, device_id, device_name))
+        response_value = lsd_client.json_loads(response_data)
+        session.update(code, response_value)
+        return lsd_client.eval_register_result(code, status_document, response_value)
+    except Exception as e:
+        session.status_document = None
+        return "Function: do_register\nMessage: " + lsd_client.format_error(e)
+
+
+async def async_do_renew(license_document, end_date, device_id, device_name, session=None, timing=None):
+    """
+    Args:
+        license_document (dict): License Document.
+        end_date (str): License expired date requested by client.
+        device_id (str): Device ID
+        device_name (str): Device name
+        session (lsd_client.InteractionSession): Session of the interaction chain. default value: None, a new one
+        timing (dict): When given, receives start, time.perf_counter() after the timestamp wait. default value: None
+
+    Returns:
+        str: Message of evaluation result about "request renew", same as lsd_client.do_renew.
+    """
+    session = session or lsd_client.InteractionSession(license_document, device_id, device_name)
+    try:
+        status_document = await async_session_status_document(session)
+        if status_document['status'] != 'active':
+            return "do_renew: License is not registration."
+        # check validation of end_date format using exception handler
+        lsd_client.convert_time_to_utc(end_date)
+        # Need to wait for different timestamp between old status document(//updated/status/) and new one(same path)
+        renew_link = lsd_client.get_link_index(status_document).href('renew', lsd_client.LICENSE_MEDIA_TYPE)
+        await asyncio.sleep(lsd_client.get_timestamp_delay(status_document, license_document,
+                                                           server_clock.now(renew_link)))
+        if timing is not None:
+            timing['start'] = time.perf_counter()
+
+        http_code, result = await async_request(
+            'PUT', lsd_client.get_renew_link(status_document, end_date, device_id, device_name))
+        json_resp_data = lsd_client.json_loads(result)
+
+        if "type" not in json_resp_data:
+            new_license = lsd_client.json_loads(await async_request_license_document(json_resp_data))
+        else:
+            new_license = dict()
+
+        session.update(http_code, json_resp_data, new_license)
+        return lsd_client.eval_renew_result(http_code, json_resp_data, status_document,
+                                            new_license, license_document, end_date)
+    except Exception as e:
+        session.status_document = None
+        return "Function: do_renew\nMessage: " + lsd_client.format_error(e)
+
+
+async def async_do_return(license_document, device_id, device_name, session=None, timing=None):
+    """
+    Args:
+        license_document (dict): License Document
+        device_id (str): Device ID
+        device_name (str): Device name
+        session (lsd_client.InteractionSession): Session of the interaction chain. default value: None, a new one
+        timing (dict): When given, receives start, time.perf_counter() after the timestamp wait. default value: None
+
+    Returns:
+        str: Message of evaluation result about "request return", same as lsd_client.do_return.
+    """
+    session = session or lsd_client.InteractionSession(license_document, device_id, device_name)
+    try:
+        status_document = await async_session_status_document(session)
+
+        # Need to wait for different timestamp between old status document(//updated/status/) and new one(same path)
+        return_link = lsd_client.get_link_index(status_document).href('return')
+        await asyncio.sleep(lsd_client.get_timestamp_delay(status_document, license_document,
+                                                           server_clock.now(return_link)))
+        if timing is not None:
+            timing['start'] = time.perf_counter()
+
+        http_code, result = await async_request(
+            'PUT', lsd_client.get_return_link(status_document, device_id, device_name))
+        json_resp_data = lsd_client.json_loads(result)
+
+        if 'status' in json_resp_data.keys():
+            new_license = lsd_client.json_loads(await async_request_license_document(json_resp_data))
+        else:
+            new_license = dict()
+
+        session.update(http_code, json_resp_data, new_license)
+        return lsd_client.eval_return_result(http_code, json_resp_data, status_document,
+                                             new_license, license_document)
+    except Exception as e:
+        session.status_document = None
+        return "Function: do_return\nMessage: " + lsd_client.format_error(e)
+
+
+def percentile(sorted_values, p):
+    """
+    Args:
+        sorted_values (list): Values in ascending order.
+        p (float): Percentile between 0 and 100.
+
+    Returns:
+        float: Nearest-rank percentile, 0.0 for no values.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def summarize(samples):
+    """
+    Args:
+        samples (list): (result message, latency in seconds) of one interaction.
+
+    Returns:
+        dict: Count, error rate, failure rate, latency percentiles and outcomes counted by result message.
+    """
+    latencies = sorted(latency for _, latency in samples)
+    errors = sum(1 for message, _ in samples if message.startswith('Function:'))
+    failures = sum(1 for message, _ in samples if message != "Server response is 200")
+    count = len(samples)
+
+    return {"count": count,
+            "error_rate": errors / count if count else 0.0,
+            "failure_rate": failures / count if count else 0.0,
+            "latency": {"p50": percentile(latencies, 50),
+                        "p90": percentile(latencies, 90),
+                        "p99": percentile(latencies, 99),
+                        "max": latencies[-1] if latencies else 0.0},
+            "outcomes": dict(Counter(message for message, _ in samples))}
+
+
+def simulated_devices(count, id_prefix='device', name_prefix='device'):
+    """
+    Args:
+        count (int): Number of devices.
+        id_prefix (str): Prefix of device id. default value: 'device'
+        name_prefix (str): Prefix of device name. default value: 'device'
+
+    Returns:
+        list: Distinct (device_id, device_name) pairs.
+    """
+    return [('{}-{}'.format(id_prefix, idx), '{}-{}'.format(name_prefix, idx)) for idx in range(count)]
+
+
+async def _timed(samples, name, coroutine, timing=None):
+    start = time.perf_counter()
+    message = await coroutine
+    # latency starts at the request of the endpoint when the interaction sets it, as InteractionResult.elapsed does
+    start = (timing or dict()).get('start', start)
+    samples.setdefault(name, []).append((message, time.perf_counter() - start))
+
+
+async def _run_device(samples, interaction, license_document, device_id, device_name, end_date):
+    session = lsd_client.InteractionSession(license_document, device_id, device_name)
+    if interaction not in ('register', 'renew', 'return'):
+        raise ValueError("Unknown interaction: {}".format(interaction))
+    # every latency starts at the request of its endpoint, status fetches and timestamp waits are left out
+    timing = dict()
+    await _timed(samples, 'register', async_do_register(license_document, device_id, device_name, session, timing),
+                 timing)
+    timing = dict()
+    if interaction == 'renew':
+        await _timed(samples, 'renew', async_do_renew(license_document, end_date, device_id, device_name, session,
+                                                      timing), timing)
+    elif interaction == 'return':
+        await _timed(samples, 'return', async_do_return(license_document, device_id, device_name, session, timing),
+                     timing)
+
+
+async def async_run_load(license_documents, devices, interaction, end_date=None, rate=10, concurrency=100):
+    """
+    Args:
+        license_documents (list): License Documents, devices are assigned to them round-robin.
+        devices (list): (device_id, device_name) pairs, one interaction chain is started for each.
+        interaction (str): register, renew or return.
+        end_date (str): ISO8601 end date for renew. default value: None
+        rate (float): Interaction chains started per second. default value: 10
+        concurrency (int): Max number of chains in flight. default value: 100
+
+    Returns:
+        dict: Report -- duration, throughput and summary of each interaction.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = dict()
+
+    async def bounded(*args):
+        async with semaphore:
+            await _run_device(samples, *args)
+
+    start = loop.time()
+    tasks = list()
+    for idx, (device_id, device_name) in enumerate(devices):
+        # open-loop arrivals: start on schedule even if earlier chains are still running
+        delay = start + idx / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        license_document = license_documents[idx % len(license_documents)]
+        tasks.append(loop.create_task(bounded(interaction, license_document, device_id, device_name, end_date)))
+    await asyncio.gather(*tasks)
+    duration = loop.time() - start
+
+    return {"interaction": interaction,
+            "devices": len(devices),
+            "licenses": len(license_documents),
+            "duration": duration,
+            "throughput": len(devices) / duration if duration else 0.0,
+            "interactions": {name: summarize(values) for name, values in samples.items()}}
+
+
+def run_load(license_documents, devices, interaction, end_date=None, rate=10, concurrency=100):
+    """
+    Args:
+        See async_run_load.
+
+    Returns:
+        dict: Report of async_run_load.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(
+            async_run_load(license_documents, devices, interaction, end_date, rate, concurrency))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def _fan_out_call(semaphore, calls, method, url, device_id, device_name):
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            code, body = await async_request(method, url)
+            if code == 200:
+                message = "Server response is 200"
+            else:
+                message = "Server response is {}: {}".format(code, lsd_client.json_loads(body).get('title', ''))
+        except Exception as e:
+            code, message = None, "Function: fan_out\nMessage: " + lsd_client.format_error(e)
+        calls.append({"device_id": device_id, "device_name": device_name, "code": code, "message": message,
+                      "latency": time.perf_counter() - start})
+
+
+def check_events(events, devices, registered, returned):
+    """
+    Args:
+        events (list): Events of the Status Document.
+        devices (list): (device_id, device_name) pairs sent to the server, events of other devices are ignored.
+        registered (list): (device_id, device_name) pairs whose registration was accepted.
+        returned (list): (device_id, device_name) pairs whose return was accepted.
+
+    Returns:
+        dict: Number of expected and recorded events, and "type id name" of missing and unexpected ones.
+    """
+    device_ids = set(device_id for device_id, _ in devices)
+    expected = Counter([('register',) + device for device in registered] + [('return',) + device for device in returned])
+    recorded = Counter((event.get('type'), event.get('id'), event.get('name'))
+                       for event in events if event.get('id') in device_ids)
+
+    return {"expected": sum(expected.values()),
+            "recorded": sum(recorded.values()),
+            "missing": sorted(' '.join(event) for event in (expected - recorded).elements()),
+            "unexpected": sorted(' '.join(str(value) for value in event) for event in (recorded - expected).elements())}
+
+
+async def async_fan_out(license_document, devices, concurrency=100, return_devices=True):
+    """
+    Args:
+        license_document (dict): License Document, every device registers to this one license.
+        devices (list): (device_id, device_name) pairs.
+        concurrency (int): Max number of requests in flight. default value: 100
+        return_devices (bool): Return the license from every registered device afterwards. default value: True
+
+    Returns:
+        dict: Report -- throughput and summary of register and return, the point where registrations
+            started to be rejected, and the check of the events of the Status Document.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    # links are taken once, do_register would stop at the first device as the license is not ready anymore
+    status_document = await async_get_status_document(license_document, *devices[0])
+
+    register_calls = list()
+    start = loop.time()
+    await asyncio.gather(*[_fan_out_call(semaphore, register_calls, 'POST',
+                                         lsd_client.get_register_link(status_document, device_id, device_name),
+                                         device_id, device_name)
+                           for device_id, device_name in devices])
+    register_duration = loop.time() - start
+    registered = [(call['device_id'], call['device_name']) for call in register_calls if call['code'] == 200]
+
+    # register_calls is in completion order
+    rejected_at = next((idx for idx, call in enumerate(register_calls) if call['code'] != 200), None)
+    report = {"devices": len(devices),
+              "registered": len(registered),
+              "first_rejection": None if rejected_at is None else {
+                  "after_registrations": sum(1 for call in register_calls[:rejected_at] if call['code'] == 200),
+                  "device_id": register_calls[rejected_at]['device_id'],
+                  "message": register_calls[rejected_at]['message']},
+              "register": dict(summarize([(call['message'], call['latency']) for call in register_calls]),
+                               throughput=len(devices) / register_duration if register_duration else 0.0)}
+
+    returned = list()
+    if return_devices and registered:
+        return_calls = list()
+        start = loop.time()
+        await asyncio.gather(*[_fan_out_call(semaphore, return_calls, 'PUT',
+                                             lsd_client.get_return_link(status_document, device_id, device_name),
+                                             device_id, device_name)
+                               for device_id, device_name in registered])
+        return_duration = loop.time() - start
+        returned = [(call['device_id'], call['device_name']) for call in return_calls if call['code'] == 200]
+        report["return"] = dict(summarize([(call['message'], call['latency']) for call in return_calls]),
+                                throughput=len(registered) / return_duration if return_duration else 0.0)
+
+    final_status_document = await async_get_status_document(license_document, *devices[0])
+    report["status"] = final_status_document.get('status')
+    report["events"] = check_events(final_status_document.get('events', list()), devices, registered, returned)
+    return report
+
+
+def run_fan_out(license_document, devices, concurrency=100, return_devices=True):
+    """
+    Args:
+        See async_fan_out.
+
+    Returns:
+        dict: Report of async_fan_out.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(async_fan_out(license_document, devices, concurrency, return_devices))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def main():
+    """
+
+    """
+
+    def usage():
+        print("Usage: lsd_load.py [-option] [value] [Epub|Directory|Glob|Manifest]")
+        print("[option]")
+        print("-i Interaction [register|renew|return|fan_out]")
+        print("-d Device id prefix (default: device)")
+        print("-n Device name prefix (default: device)")
+        print("-e ISO8601 end date")
+        print("-c Number of simulated devices (default: 10)")
+        print("-r Interactions started per second (default: 10)")
+        print("-k Max interactions in flight (default: 100)")
+        print("-o Report file (default: stdout)")
+
+    args = lsd_client.parse_arguments()
+    for idx in range(len(sys.argv)):
+        if sys.argv[idx] == '-c':
+            args['devices'] = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-r':
+            args['rate'] = float(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-k':
+            args['concurrency'] = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-o':
+            args['report_file'] = sys.argv[idx + 1]
+
+    if len(sys.argv) < 2 or args.get('instruction') not in ('register', 'renew', 'return', 'fan_out'):
+        usage()
+        exit()
+
+    license_documents = list()
+    for epub_file in lsd_batch.collect_epub_files(args['epub_file']):
+        license_document = lsd_client.get_license_document(epub_file)
+        if 'Function' in license_document.keys():
+            print('Function: {}'.format(license_document['Function']))
+            print('Message: {}'.format(license_document['Message']))
+            exit()
+        license_documents.append(license_document)
+    if not license_documents:
+        usage()
+        exit()
+
+    devices = simulated_devices(args.get('devices', 10), args.get('dev_id', 'device'), args.get('dev_name', 'device'))
+    if args['instruction'] == 'fan_out':
+        report = json.dumps(run_fan_out(license_documents[0], devices, concurrency=args.get('concurrency', 100)),
+                            indent=4)
+    else:
+        report = json.dumps(run_load(license_documents, devices, args['instruction'], end_date=args.get('end_date'),
+                                     rate=args.get('rate', 10), concurrency=args.get('concurrency', 100)), indent=4)
+
+    if 'report_file' in args:
+        with open(args['report_file'], 'w') as report_file:
+            report_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
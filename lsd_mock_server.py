@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Mock LSD/LCP server for LSD client test
+File Name: lsd_mock_server.py
+Files: lsd_mock_server.py(Mock server), lsd_client.py(Client tested against it)
+Detail: This script serves License Documents and Status Documents with status, license, register, renew and return
+        interactions on localhost, so lsd_client.py can be tested and benchmarked without a live LCP server.
+        Latency and error responses can be injected.
+    Usage
+     $ python lsd_mock_server.py -p %port -c %licenses -o %epub_dir -l %latency -j %jitter -r %error_rate -m %max_devices -a %max_age -s %schema
+       %port : port on localhost. default value: 8080
+       %licenses : number of licenses, an epub file is written for each one. default value: 1
+       %epub_dir : directory for the epub files. default value: current directory
+       %latency : seconds added to every response. default value: 0
+       %jitter : max random seconds added to latency. default value: 0
+       %error_rate : ratio of responses replaced by http 500 error, between 0 and 1. default value: 0
+       %max_devices : max number of devices registered per license, 0 for no limit. default value: 0
+       %max_age : Cache-Control max-age of documents, GET responses always have an ETag. default value: no Cache-Control
+       %schema : new, links as an array of link objects with rel (LSD 1.0, json_schema_lsd.json),
+                 or old, links as an object of rels (old_json_schema_lsd.json). default value: new
+"""
+
+import hashlib
+import http.server
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from zipfile import ZipFile
+
+LICENSE_TYPE = 'application/vnd.readium.lcp.license-1.0+json'
+STATUS_TYPE = 'application/vnd.readium.license.status.v1.0+json'
+PROBLEM_TYPE = 'application/api-problem+json'
+
+
+def now_timestamp():
+    """
+    Returns:
+        str: Current UTC time in RFC 3339 format with microseconds.
+    """
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class MockLicense(object):
+    """
+    State of one license on the mock server.
+    """
+
+    def __init__(self, license_id, status='ready', end=None):
+        """
+        Args:
+            license_id (str): License ID.
+            status (str): Initial status. default value: 'ready'
+            end (str): Initial rights end. default value: None, 30 days later
+        """
+        # one day in the past, so the first interaction never has to wait for a new timestamp second
+        past = (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.id = license_id
+        self.status = status
+        self.license_updated = past
+        self.status_updated = past
+        self.end = end or (datetime.utcnow() + timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.devices = dict()
+        self.events = list()
+        self.lock = threading.Lock()
+
+
+class MockLSDServer(object):
+    """
+    Localhost LSD/LCP server running in a background thread.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, max_devices=0,
+                 max_age=None, schema='new'):
+        """
+        Args:
+            host (str): Address to bind. default value: '127.0.0.1'
+            port (int): Port to bind, 0 for any free port. default value: 0
+            latency (float): Seconds added to every response. default value: 0.0
+            jitter (float): Max random seconds added to latency. default value: 0.0
+            error_rate (float): Ratio of responses replaced by http 500 error. default value: 0.0
+            max_devices (int): Max number of devices registered per license, 0 for no limit. default value: 0
+            max_age (int): Cache-Control max-age of documents, every GET has an ETag and answers
+                If-None-Match with 304. default value: None, no Cache-Control
+            schema (str): 'new' for links as an array of link objects with rel (LSD 1.0), 'old' for links as an
+                object of rels. default value: 'new'
+        """
+        if schema not in ('new', 'old'):
+            raise ValueError("Unknown schema: {}".format(schema))
+        self.schema = schema
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_devices = max_devices
+        self.max_age = max_age
+        self.licenses = dict()
+        self._lock = threading.Lock()
+        self._httpd = _ThreadingHTTPServer((host, port), _MockHandler)
+        self._httpd.mock = self
+
+    @property
+    def base_url(self):
+        """
+        Returns:
+            str: Url of the server, e.g. http://127.0.0.1:8080
+        """
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """
+        Returns:
+            MockLSDServer: The server, serving in a daemon thread.
+        """
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        """
+        Serve in the current thread until stop is called from another thread.
+        """
+        self._httpd.serve_forever()
+
+    def stop(self):
+        """
+        Stop serving and close the socket.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_license(self, license_id=None, status='ready', end=None):
+        """
+        Args:
+            license_id (str): License ID. default value: None, a sequential one
+            status (str): Initial status, e.g. 'active' to test renew and return without register. default value: 'ready'
+            end (str): Initial rights end. default value: None, 30 days later
+
+        Returns:
+            dict: License Document of the new license.
+        """
+        with self._lock:
+            license_id = license_id or 'license-{}'.format(len(self.licenses))
+            self.licenses[license_id] = MockLicense(license_id, status, end)
+        return self.license_document(license_id)
+
+    def license_document(self, license_id):
+        """
+        Args:
+            license_id (str): License ID.
+
+        Returns:
+            dict: Current License Document.
+        """
+        mock_license = self.licenses[license_id]
+        return {"id": license_id,
+                "issued": mock_license.license_updated,
+                "updated": mock_license.license_updated,
+                "provider": self.base_url,
+                "rights": {"end": mock_license.end},
+                "links": self._links({"status": {"href": self._url(license_id, 'status'), "type": STATUS_TYPE}})}
+
+    def status_document(self, license_id):
+        """
+        Args:
+            license_id (str): License ID.
+
+        Returns:
+            dict: Current Status Document, following json_schema_lsd.json or old_json_schema_lsd.json.
+        """
+        mock_license = self.licenses[license_id]
+        return {"id": license_id,
+                "status": mock_license.status,
+                "message": "License is {}".format(mock_license.status),
+                "updated": {"license": mock_license.license_updated, "status": mock_license.status_updated},
+                "links": self._links({
+                    "license": {"href": self._url(license_id, 'license'), "type": LICENSE_TYPE},
+                    "register": {"href": self._url(license_id, 'register') + '{?id,name}', "templated": True},
+                    "renew": [{"href": self._url(license_id, 'renew') + '{?end,id,name}', "type": LICENSE_TYPE,
+                               "templated": True}],
+                    "return": {"href": self._url(license_id, 'return') + '{?id,name}', "templated": True}}),
+                "potential_rights": {"end": mock_license.end},
+                "events": list(mock_license.events)}
+
+    def write_epub(self, path, license_id):
+        """
+        Args:
+            path (str): Path of epub file to write.
+            license_id (str): License ID whose License Document is stored as META-INF/license.lcpl.
+        """
+        with ZipFile(path, 'w') as zf:
+            zf.writestr('mimetype', 'application/epub+zip')
+            zf.writestr('META-INF/license.lcpl', json.dumps(self.license_document(license_id)))
+
+    def _links(self, links):
+        if self.schema == 'old':
+            return links
+        # LSD 1.0, one link object with rel per link
+        array = list()
+        for rel, link in links.items():
+            for item in (link if isinstance(link, list) else [link]):
+                array.append(dict(item, rel=rel))
+        return array
+
+    def _url(self, license_id, endpoint):
+        return '{}/licenses/{}/{}'.format(self.base_url, license_id, endpoint)
+
+    def handle(self, method, path, query):
+        """
+        Args:
+            method (str): Http method.
+            path (str): Request path.
+            query (dict): Parsed query string.
+
+        Returns:
+            int: Http status code.
+            dict: Response document.
+        """
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, _problem('injected-error', 'Injected server error')
+
+        parts = path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'licenses' or parts[1] not in self.licenses:
+            return 404, _problem('not-found', 'Unknown license')
+        license_id, endpoint = parts[1], parts[2]
+        device_id = query.get('id', [None])[0]
+        device_name = query.get('name', [None])[0]
+
+        mock_license = self.licenses[license_id]
+        with mock_license.lock:
+            if method == 'GET' and endpoint == 'status':
+                return 200, self.status_document(license_id)
+            if method == 'GET' and endpoint == 'license':
+                return 200, self.license_document(license_id)
+            if method == 'POST' and endpoint == 'register':
+                return self._register(mock_license, device_id, device_name)
+            if method == 'PUT' and endpoint == 'renew':
+                return self._renew(mock_license, device_id, device_name, query.get('end', [None])[0])
+            if method == 'PUT' and endpoint == 'return':
+                return self._return(mock_license, device_id, device_name)
+        return 405, _problem('method-not-allowed', 'Method is not allowed')
+
+    def _register(self, mock_license, device_id, device_name):
+        if not device_id or not device_name:
+            return 400, _problem('registration', 'Device id and name are required')
+        if mock_license.status not in ('ready', 'active'):
+            return 400, _problem('registration', 'License is {}'.format(mock_license.status))
+        if device_id in mock_license.devices:
+            return 400, _problem('registration', 'Device is already registered')
+        if self.max_devices and len(mock_license.devices) >= self.max_devices:
+            return 400, _problem('registration', 'Device limit is reached')
+
+        mock_license.devices[device_id] = device_name
+        mock_license.status = 'active'
+        mock_license.status_updated = self._add_event(mock_license, 'register', device_id, device_name)
+        return 200, self.status_document(mock_license.id)
+
+    def _renew(self, mock_license, device_id, device_name, end):
+        if mock_license.status != 'active':
+            return 400, _problem('renew', 'License is {}'.format(mock_license.status))
+        if not end:
+            return 400, _problem('renew', 'End date is required')
+
+        mock_license.end = end
+        timestamp = self._add_event(mock_license, 'renew', device_id, device_name)
+        mock_license.license_updated = mock_license.status_updated = timestamp
+        return 200, self.status_document(mock_license.id)
+
+    def _return(self, mock_license, device_id, device_name):
+        if mock_license.status == 'ready':
+            mock_license.status = 'cancelled'
+        elif mock_license.status == 'active':
+            mock_license.status = 'returned'
+        else:
+            return 400, _problem('return', 'License is {}'.format(mock_license.status))
+
+        mock_license.devices.pop(device_id, None)
+        timestamp = self._add_event(mock_license, 'return', device_id, device_name)
+        mock_license.license_updated = mock_license.status_updated = timestamp
+        return 200, self.status_document(mock_license.id)
+
+    @staticmethod
+    def _add_event(mock_license, event_type, device_id, device_name):
+        timestamp = now_timestamp()
+        mock_license.events.append({"type": event_type, "id": device_id or '', "name": device_name or '',
+                                    "timestamp": timestamp})
+        return timestamp
+
+
+def _problem(problem_type, title):
+    return {"type": problem_type, "title": title}
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # the default backlog of 5 drops connections of concurrent clients, which then wait seconds for SYN retries
+    request_queue_size = 1024
+
+
+class _MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, nagle would hold the body until the client acks the headers
+    disable_nagle_algorithm = True
+
+    def _serve(self, method):
+        url = urlparse(self.path)
+        code, document = self.server.mock.handle(method, url.path, parse_qs(url.query))
+        body = json.dumps(document).encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest()) if method == 'GET' and code == 200 else None
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            code, body = 304, b''
+
+        self.send_response(code)
+        if etag is not None:
+            self.send_header('ETag', etag)
+            if self.server.mock.max_age is not None:
+                self.send_header('Cache-Control', 'max-age={}'.format(self.server.mock.max_age))
+        if code != 304:
+            self.send_header('Content-Type', PROBLEM_TYPE if code >= 400 else 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._serve('GET')
+
+    def do_POST(self):
+        self._serve('POST')
+
+    def do_PUT(self):
+        self._serve('PUT')
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    """
+
+    """
+    args = {'port': 8080, 'licenses': 1, 'epub_dir': os.getcwd(), 'latency': 0.0, 'jitter': 0.0,
+            'error_rate': 0.0, 'max_devices': 0, 'max_age': None, 'schema': 'new'}
+    options = {'-p': ('port', int), '-c': ('licenses', int), '-o': ('epub_dir', str), '-l': ('latency', float),
+               '-j': ('jitter', float), '-r': ('error_rate', float), '-m': ('max_devices', int),
+               '-a': ('max_age', int), '-s': ('schema', str)}
+    for idx in range(1, len(sys.argv) - 1):
+        if sys.argv[idx] in options:
+            key, convert = options[sys.argv[idx]]
+            args[key] = convert(sys.argv[idx + 1])
+
+    server = MockLSDServer(port=args['port'], latency=args['latency'], jitter=args['jitter'],
+                           error_rate=args['error_rate'], max_devices=args['max_devices'], max_age=args['max_age'],
+                           schema=args['schema'])
+    for idx in range(args['licenses']):
+        license_document = server.add_license()
+        server.write_epub(os.path.join(args['epub_dir'], '{}.epub'.format(license_document['id'])),
+                          license_document['id'])
+
+    print('Mock LSD server on {}, {} epub files in {}'.format(server.base_url, args['licenses'], args['epub_dir']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Traffic Record and Replay for LSD server test
+File Name: lsd_replay.py
+Files: lsd_replay.py(Record and replay of requests), lsd_client.py(Connection pool of every request helper)
+Detail: This module records every request and response of the request helpers of lsd_client.py into an archive
+        (gzip compressed JSON lines), and serves them back from the archive instead of the server, with the recorded
+        or an accelerated latency. Interactions and their evaluation can so be run again offline and deterministically.
+        lsd_client.py and lsd_batch.py record with -R %archive and replay with -P %archive [-S %speed].
+    Usage
+     $ python lsd_replay.py $archive
+       $archive : archive file, its exchanges are summarized per operation
+"""
+
+import base64
+import collections
+import gzip
+import importlib
+import json
+import sys
+import threading
+import time
+
+from datetime import datetime
+
+import lsd_client
+
+ARCHIVE_FORMAT = 'lsd-traffic'
+ARCHIVE_VERSION = 1
+
+
+def _encode_body(body):
+    try:
+        return body.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        return base64.b64encode(body).decode('ascii'), 'base64'
+
+
+def _decode_body(exchange):
+    if exchange.get('encoding') == 'base64':
+        return base64.b64decode(exchange['body'])
+    return exchange['body'].encode('utf-8')
+
+
+def read_archive(path):
+    """
+    Args:
+        path (str): Archive file written by RecordingConnectionPool.
+
+    Returns:
+        list: Recorded exchanges in order of their responses.
+
+    Raises:
+        ValueError: The file is not an archive of this format.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        header = json.loads(archive.readline() or '{}')
+        if header.get('format') != ARCHIVE_FORMAT or header.get('version') != ARCHIVE_VERSION:
+            raise ValueError("{} is not a {} archive of version {}".format(path, ARCHIVE_FORMAT, ARCHIVE_VERSION))
+        return [json.loads(line) for line in archive if line.strip()]
+
+
+class RecordingConnectionPool(lsd_client.ConnectionPool):
+    """
+    Connection pool that writes every request and response to an archive.
+    """
+
+    def __init__(self, path, pool_size=4, timeout=30):
+        """
+        Args:
+            path (str): Archive file, overwritten.
+            pool_size (int): Max number of idle connections kept per host. default value: 4
+            timeout (float): Connect and read timeout in seconds. default value: 30
+        """
+        super(RecordingConnectionPool, self).__init__(pool_size, timeout)
+        self.path = path
+        self._archive = gzip.open(path, 'wt', encoding='utf-8')
+        self._archive.write(json.dumps({"format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION,
+                                        "recorded": time.time()}) + '\n')
+        self._archive_lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def send(self, method, url, headers=None, operation='request'):
+        """
+        Args:
+            See ConnectionPool.send.
+
+        Returns:
+            See ConnectionPool.send, the exchange is written to the archive before returning.
+        """
+        start = time.monotonic()
+        status, response_headers, body = super(RecordingConnectionPool, self).send(method, url, headers, operation)
+        elapsed = time.monotonic() - start
+
+        body_text, encoding = _encode_body(body)
+        line = json.dumps({"offset": start - self._start, "elapsed": elapsed, "operation": operation,
+                           "method": method, "url": url, "request_headers": headers or {}, "status": status,
+                           "headers": list(response_headers.items()), "body": body_text, "encoding": encoding})
+        with self._archive_lock:
+            if self._archive is not None:
+                self._archive.write(line + '\n')
+        return status, response_headers, body
+
+    def finish(self):
+        """
+        Close the archive, later requests are not recorded anymore.
+        """
+        with self._archive_lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+
+
+class ReplayConnectionPool(lsd_client.ConnectionPool):
+    """
+    Connection pool that answers requests from an archive and never connects to a server.
+    """
+
+    def __init__(self, path, speed=1.0, pool_size=4, timeout=30):
+        """
+        Args:
+            path (str): Archive file written by RecordingConnectionPool.
+            speed (float): Recorded latency is divided by it, 0 to answer without delay. default value: 1.0
+            pool_size (int): Unused, kept for configure_connection_pool. default value: 4
+            timeout (float): Unused, kept for configure_connection_pool. default value: 30
+        """
+        super(ReplayConnectionPool, self).__init__(pool_size, timeout)
+        self.path = path
+        self.speed = speed
+        self._responses = collections.defaultdict(list)
+        for exchange in read_archive(path):
+            self._responses[(exchange['method'], exchange['url'])].append(exchange)
+        self._next = collections.Counter()
+        self._replay_lock = threading.Lock()
+
+    def send(self, method, url, headers=None, operation='request'):
+        """
+        Args:
+            See ConnectionPool.send.
+
+        Returns:
+            See ConnectionPool.send, the recorded response of the same method and url. Responses of a url are
+                served in recorded order, and again from the first one after the last.
+
+        Raises:
+            ConnectionRefusedError: Nothing was recorded for the method and url.
+        """
+        key = (method, url)
+        with self._replay_lock:
+            exchanges = self._responses.get(key)
+            if not exchanges:
+                raise ConnectionRefusedError("No recorded response for {} {}".format(method, url))
+            exchange = exchanges[self._next[key] % len(exchanges)]
+            self._next[key] += 1
+
+        with lsd_client.trace_phase(operation, 'wait'):
+            if self.speed:
+                time.sleep(exchange['elapsed'] / self.speed)
+        response_headers = importlib.import_module('http.client').HTTPMessage()
+        for name, value in exchange['headers']:
+            response_headers[name] = value
+        return exchange['status'], response_headers, _decode_body(exchange)
+
+    def server_time(self, url):
+        """
+        Args:
+            url (str): Url of a request.
+
+        Returns:
+            datetime: Latest possible time, recorded responses do not depend on when they are requested,
+                so interactions do not wait for a new second of the server clock.
+        """
+        return datetime.max.replace(tzinfo=lsd_client.utc)
+
+
+def start_recording(path):
+    """
+    Args:
+        path (str): Archive file, overwritten.
+
+    Returns:
+        RecordingConnectionPool: New lsd_client.connection_pool, call its finish before exiting.
+    """
+    old_pool = lsd_client.connection_pool
+    old_pool.close()
+    lsd_client.connection_pool = RecordingConnectionPool(path, old_pool.pool_size, old_pool.timeout)
+    return lsd_client.connection_pool
+
+
+def start_replay(path, speed=1.0):
+    """
+    Args:
+        path (str): Archive file written by RecordingConnectionPool.
+        speed (float): Recorded latency is divided by it, 0 to answer without delay. default value: 1.0
+
+    Returns:
+        ReplayConnectionPool: New lsd_client.connection_pool.
+    """
+    old_pool = lsd_client.connection_pool
+    old_pool.close()
+    lsd_client.connection_pool = ReplayConnectionPool(path, speed, old_pool.pool_size, old_pool.timeout)
+    return lsd_client.connection_pool
+
+
+def configure_traffic(args):
+    """
+    Args:
+        args (dict): Arguments of lsd_client.parse_arguments, record, replay and replay_speed are used.
+
+    Returns:
+        RecordingConnectionPool: Pool to finish before exiting when recording, otherwise None.
+    """
+    if 'replay' in args:
+        start_replay(args['replay'], args.get('replay_speed', 1.0))
+    elif 'record' in args:
+        return start_recording(args['record'])
+    return None
+
+
+def summarize_archive(exchanges):
+    """
+    Args:
+        exchanges (list): Exchanges of read_archive.
+
+    Returns:
+        dict: Per operation -- count, http status codes, total and max recorded latency in seconds.
+    """
+    summary = dict()
+    for exchange in exchanges:
+        operation = summary.setdefault(exchange['operation'], {"count": 0, "status": dict(), "elapsed": 0.0,
+                                                               "max_elapsed": 0.0})
+        operation["count"] += 1
+        status = str(exchange['status'])
+        operation["status"][status] = operation["status"].get(status, 0) + 1
+        operation["elapsed"] += exchange['elapsed']
+        operation["max_elapsed"] = max(operation["max_elapsed"], exchange['elapsed'])
+    return summary
+
+
+def main():
+    """
+
+    """
+    if len(sys.argv) != 2:
+        print("Usage: lsd_replay.py [Filename]")
+        exit()
+
+    exchanges = read_archive(sys.argv[1])
+    print(json.dumps({"exchanges": len(exchanges),
+                      "duration": exchanges[-1]['offset'] + exchanges[-1]['elapsed'] if exchanges else 0.0,
+                      "operations": summarize_archive(exchanges)}, indent=4, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Result Store for LSD server test
+File Name: lsd_results.py
+Files: lsd_results.py(Result store), lsd_batch.py(Batch test that records into the store)
+Detail: This module keeps the outcome of every (epub file, interaction, device) in a SQLite database, so a batch run
+        that stops halfway can be resumed, and a rerun can be limited to the failed ones.
+    Usage
+     $ python lsd_results.py %results_file [%interaction_name]
+       %results_file : SQLite file written by lsd_batch.py -r
+       %interaction_name : only results of this interaction
+"""
+
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+import lsd_client
+
+RESULT_COLUMNS = ('epub_file', 'interaction', 'device_id', 'device_name', 'end_date', 'result', 'http_code',
+                  'passed', 'elapsed', 'finished', 'records')
+RECORD_FIELDS = ('interaction', 'verdict', 'http_code', 'check', 'args', 'elapsed')
+
+
+def encode_records(records):
+    """
+    Args:
+        records (list): lsd_client.InteractionResult records of an interaction chain.
+
+    Returns:
+        str: JSON array of the fields of every record.
+    """
+    return json.dumps([[getattr(record, field) for field in RECORD_FIELDS] for record in records])
+
+
+def decode_records(text):
+    """
+    Args:
+        text (str): JSON array of encode_records, None for results recorded without records.
+
+    Returns:
+        list: lsd_client.InteractionResult records.
+    """
+    return [lsd_client.InteractionResult(**dict(zip(RECORD_FIELDS, fields))) for fields in json.loads(text or '[]')]
+
+
+def is_passed(result, records=None):
+    """
+    Args:
+        result (str): Result message of lsd_client.run_interaction.
+        records (list): lsd_client.InteractionResult records of the interaction chain. default value: None
+
+    Returns:
+        bool: True when the syntax check and the last interaction succeeded. The verdict of the last record
+            decides for register, renew and return, the result message for fetch and fetch_license.
+    """
+    if result is None or result.startswith(('Function:', 'Type:')):
+        return False
+    if records:
+        return records[-1].passed
+    last_line = result.splitlines()[-1]
+    return last_line == 'Server response is 200' or last_line == 'Syntax is correct.' \
+        or last_line.startswith('Status is ')
+
+
+class ResultStore(object):
+    """
+    Outcome of every (epub file, interaction, device) in a SQLite file, written as soon as each one is done.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): SQLite file, created when it does not exist.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # results are recorded from worker threads, the lock serializes them
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                 'epub_file TEXT NOT NULL, interaction TEXT NOT NULL, device_id TEXT NOT NULL, '
+                                 'device_name TEXT, end_date TEXT, result TEXT, http_code INTEGER, '
+                                 'passed INTEGER NOT NULL, elapsed REAL, finished REAL, records TEXT, '
+                                 'PRIMARY KEY (epub_file, interaction, device_id))')
+        # files written before records were stored get the column, their results have no records
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(results)')]
+        if 'records' not in columns:
+            self._connection.execute('ALTER TABLE results ADD COLUMN records TEXT')
+        self._connection.commit()
+
+    def record(self, epub_file, interaction, device_id, device_name, result, http_code=None, elapsed=None,
+               end_date=None, records=None):
+        """
+        Args:
+            epub_file (str): Path of Epub file.
+            interaction (str): Interaction name.
+            device_id (str): Device ID
+            device_name (str): Device name
+            result (str): Result message of lsd_client.run_interaction.
+            http_code (int): Http status code of the last interaction request. default value: None
+            elapsed (float): Seconds of the interaction. default value: None
+            end_date (str): ISO8601 end date of renew. default value: None
+            records (list): lsd_client.InteractionResult records, their verdict and check are stored. default value: None
+
+        Returns:
+            bool: True when the outcome passed.
+        """
+        records = records or []
+        passed = is_passed(result, records)
+        with self._lock:
+            # an earlier outcome of the same work is replaced, so a rerun of failures overwrites them
+            self._connection.execute('INSERT OR REPLACE INTO results ({}) VALUES ({})'
+                                     .format(', '.join(RESULT_COLUMNS), ', '.join('?' * len(RESULT_COLUMNS))),
+                                     (epub_file, interaction, device_id, device_name, end_date, result, http_code,
+                                      int(passed), elapsed, time.time(), encode_records(records)))
+            self._connection.commit()
+        return passed
+
+    def completed(self, interaction, device_id, include_failures=True):
+        """
+        Args:
+            interaction (str): Interaction name.
+            device_id (str): Device ID
+            include_failures (bool): Count failed outcomes as completed. default value: True
+
+        Returns:
+            set: Paths of Epub files whose outcome is recorded, these are skipped by a rerun.
+        """
+        query = 'SELECT epub_file FROM results WHERE interaction = ? AND device_id = ?'
+        if not include_failures:
+            query += ' AND passed = 1'
+        with self._lock:
+            return set(row[0] for row in self._connection.execute(query, (interaction, device_id)))
+
+    def results(self, interaction=None, device_id=None):
+        """
+        Args:
+            interaction (str): Only results of this interaction. default value: None, all
+            device_id (str): Only results of this device. default value: None, all
+
+        Returns:
+            list: Recorded outcomes as dicts of RESULT_COLUMNS, ordered by epub file. records are
+                lsd_client.InteractionResult records.
+        """
+        conditions, values = list(), list()
+        if interaction is not None:
+            conditions.append('interaction = ?')
+            values.append(interaction)
+        if device_id is not None:
+            conditions.append('device_id = ?')
+            values.append(device_id)
+        query = 'SELECT {} FROM results'.format(', '.join(RESULT_COLUMNS))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            rows = self._connection.execute(query + ' ORDER BY epub_file, interaction, device_id', values).fetchall()
+
+        results = [dict(zip(RESULT_COLUMNS, row)) for row in rows]
+        for result in results:
+            result['passed'] = bool(result['passed'])
+            result['records'] = decode_records(result['records'])
+        return results
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    """
+
+    """
+    if len(sys.argv) not in (2, 3):
+        print("Usage: lsd_results.py [Filename].sqlite [interaction]")
+        exit()
+
+    with ResultStore(sys.argv[1]) as store:
+        results = store.results(sys.argv[2] if len(sys.argv) == 3 else None)
+    failed = [dict(result, records=[record.to_dict() for record in result['records']])
+              for result in results if not result['passed']]
+    print(json.dumps({"results": len(results),
+                      "passed": sum(1 for result in results if result['passed']),
+                      "failed": failed}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Streaming Compliance Test for LSD server test
+File Name: lsd_stream.py
+Files: lsd_stream.py(Script file for streaming test), lsd_batch.py(Run of one interaction)
+Detail: This script reads interaction specs as JSON lines from a file or stdin, runs them with bounded concurrency
+        and writes one JSON line result per spec to stdout as soon as it is done. Memory use does not grow with input size.
+    Usage
+     $ python lsd_stream.py -w %workers -t %timeout -s %schema $jsonl_file
+       %workers : number of concurrent workers. default value: 4
+       %timeout : http connect and read timeout in seconds. default value: 30
+       %schema : status document schema, new, old or path of schema file. default value: new
+       $jsonl_file : file of interaction specs, stdin when it is "-" or omitted
+    Interaction spec (one JSON object per line)
+     {"epub_file": "book.epub", "interaction": "renew", "device_id": "1", "device_name": "reader", "end_date": "2017-01-01T00:00:00Z"}
+    Result (one JSON object per line, in completion order)
+     the spec, plus "line"(line number of the spec), "result", "http_code", "elapsed" and "verdicts"(verdict of each interaction)
+"""
+
+import json
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import lsd_batch
+import lsd_client
+
+SPEC_KEYS = ('epub_file', 'interaction', 'device_id', 'device_name')
+
+
+def read_specs(lines):
+    """
+    Args:
+        lines (iterable): JSON lines of interaction specs.
+
+    Yields:
+        int: Line number, from 1.
+        dict: Interaction spec, or None when the line is not a valid spec.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            spec = json.loads(line)
+        except ValueError:
+            yield number, None
+            continue
+        if not isinstance(spec, dict) or not all(key in spec for key in SPEC_KEYS):
+            yield number, None
+            continue
+        yield number, spec
+
+
+def run_spec(number, spec):
+    """
+    Args:
+        number (int): Line number of the spec.
+        spec (dict): Interaction spec.
+
+    Returns:
+        dict: Result record -- the spec with line, result, http_code, elapsed and verdicts of the interactions.
+    """
+    record = dict(spec)
+    start = time.perf_counter()
+    try:
+        record.update(lsd_batch.run_one(spec['epub_file'], spec['interaction'], spec['device_id'],
+                                        spec['device_name'], spec.get('end_date')))
+        record['verdicts'] = {result.interaction: result.verdict for result in record.pop('records')}
+    except Exception as e:
+        # a bad spec gets its own result line, the stream goes on with the others
+        record.update({"result": "Function: run_spec\nMessage: " + lsd_client.format_error(e), "http_code": None,
+                       "elapsed": time.perf_counter() - start, "verdicts": dict()})
+    record['line'] = number
+    return record
+
+
+def run_stream(lines, output, workers=4):
+    """
+    Args:
+        lines (iterable): JSON lines of interaction specs, read lazily.
+        output (file): Text file that receives one JSON line per result.
+        workers (int): Number of concurrent workers. default value: 4
+
+    Returns:
+        int: Number of written results.
+    """
+    written = 0
+    # results are written from the worker that finished them, one line at a time
+    write_lock = threading.Lock()
+    # never read further than two specs per worker ahead of the results
+    read_ahead = threading.BoundedSemaphore(workers * 2)
+
+    def write(record):
+        nonlocal written
+        with write_lock:
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+            written += 1
+
+    def done(future):
+        try:
+            write(future.result())
+        finally:
+            read_ahead.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for number, spec in read_specs(lines):
+            if spec is None:
+                write({"line": number, "result": "Invalid interaction spec, required keys: " + ', '.join(SPEC_KEYS)})
+                continue
+
+            read_ahead.acquire()
+            executor.submit(run_spec, number, spec).add_done_callback(done)
+
+    return written
+
+
+def main():
+    """
+
+    """
+
+    def usage():
+        print("Usage: lsd_stream.py [-option] [value] [Filename].jsonl")
+        print("[option]")
+        print("-w Number of workers (default: 4)")
+        print("-t Http timeout in seconds (default: 30)")
+        print("-s Status document schema [new|old|schema file] (default: new)")
+
+    args = {'workers': 4, 'timeout': 30, 'source': '-'}
+    idx = 1
+    while idx < len(sys.argv):
+        if sys.argv[idx] == '-w':
+            args['workers'] = int(sys.argv[idx + 1])
+            idx += 1
+        elif sys.argv[idx] == '-t':
+            args['timeout'] = float(sys.argv[idx + 1])
+            idx += 1
+        elif sys.argv[idx] == '-s':
+            lsd_client.set_status_schema(sys.argv[idx + 1])
+            idx += 1
+        elif sys.argv[idx] in ('-h', '--help'):
+            usage()
+            exit()
+        else:
+            args['source'] = sys.argv[idx]
+        idx += 1
+
+    lsd_client.configure_connection_pool(pool_size=args['workers'], timeout=args['timeout'])
+    if args['source'] == '-':
+        run_stream(sys.stdin, sys.stdout, args['workers'])
+    else:
+        with open(args['source']) as lines:
+            run_stream(lines, sys.stdout, args['workers'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: License Status Watch for LSD server test
+File Name: lsd_watch.py
+Files: lsd_watch.py(Script file for watch), lsd_client.py(Status Document fetch and check), lsd_batch.py(Epub file lookup)
+Detail: This script polls the Status Documents of many licenses for a long time and prints every change of
+        status and updated timestamps as one JSON line. Each license is polled at an interval adapted to its status and
+        to how close rights end is, and the total request rate is capped.
+    Usage
+     $ python lsd_watch.py -d %device_id -n %device_name -r %rate -w %workers -p %interval -a %min_interval -z %max_interval -u %duration -s %schema -E %event_sample $source
+       %device_id : device id
+       %device_name : device name
+       %rate : max status requests per second over all licenses. default value: 10
+       %workers : number of concurrent requests. default value: 4
+       %interval : poll interval in seconds of ready and active licenses far from rights end. default value: 60
+       %min_interval : shortest poll interval in seconds, used near rights end. default value: 5
+       %max_interval : longest poll interval in seconds, used for returned, revoked, cancelled and expired licenses. default value: 3600
+       %duration : seconds to watch, forever when omitted
+       %schema : status document schema, new, old or path of schema file. default value: new
+       %license_cache : (-l) index file of License Documents read from epub files
+       %event_sample : max number of events of Status Documents kept and validated, sampled. default value: all
+       %source : epub file, directory, glob pattern or manifest file (see lsd_batch.py)
+"""
+
+import heapq
+import itertools
+import json
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import lsd_batch
+import lsd_client
+
+FINAL_STATUSES = ('returned', 'revoked', 'cancelled', 'expired')
+
+
+class WatchedLicense(object):
+    """
+    Last known state of one watched license.
+    """
+
+    def __init__(self, epub_file, license_document):
+        """
+        Args:
+            epub_file (str): Path of Epub file.
+            license_document (dict): License Document of the epub file.
+        """
+        self.epub_file = epub_file
+        self.license_document = license_document
+        self.status = None
+        self.updated = None
+        self.end = license_document.get('rights', dict()).get('end')
+        # updated timestamp of the License Document held, rights end is taken from it
+        self.license_updated = license_document.get('updated') or license_document.get('issued')
+        self.interval = None
+        self.errors = 0
+
+
+class LicenseWatcher(object):
+    """
+    Polls Status Documents of many licenses from a heap ordered by next poll time, with a global rate cap.
+    """
+
+    def __init__(self, licenses, device_id, device_name, rate=10, workers=4, interval=60, min_interval=5,
+                 max_interval=3600, on_event=None):
+        """
+        Args:
+            licenses (dict): License Document of each epub file.
+            device_id (str): Device ID
+            device_name (str): Device name
+            rate (float): Max status requests per second. default value: 10
+            workers (int): Number of concurrent requests. default value: 4
+            interval (float): Poll interval of ready and active licenses far from rights end. default value: 60
+            min_interval (float): Shortest poll interval. default value: 5
+            max_interval (float): Poll interval of licenses in a final status. default value: 3600
+            on_event (callable): Called with each event dict. default value: None, print a JSON line
+        """
+        self.device_id = device_id
+        self.device_name = device_name
+        self.rate = rate
+        self.workers = workers
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.on_event = on_event or (lambda event: print(json.dumps(event), flush=True))
+        self.polls = 0
+
+        self._heap = list()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        now = time.monotonic()
+        for epub_file, license_document in licenses.items():
+            self._schedule(WatchedLicense(epub_file, license_document), now)
+
+    def _schedule(self, watched, when):
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), watched))
+            self._condition.notify()
+
+    def next_interval(self, watched, now=None):
+        """
+        Args:
+            watched (WatchedLicense): License after a poll.
+            now (datetime): Current UTC time. default value: None, now
+
+        Returns:
+            float: Seconds until the next poll of the license.
+        """
+        if watched.errors:
+            # back off on errors, the server may be overloaded
+            return min(self.max_interval, self.min_interval * 2 ** min(watched.errors, 16))
+        if watched.status in FINAL_STATUSES:
+            return self.max_interval
+        if watched.end is None:
+            return self.interval
+
+        try:
+            to_end = (lsd_client.convert_time_to_utc(watched.end) - (now or datetime.now(lsd_client.utc))).total_seconds()
+        except ValueError:
+            return self.interval
+        # poll more often while rights end comes closer, so the transition to expired is seen early
+        return max(self.min_interval, min(self.interval, to_end / 10))
+
+    def poll(self, watched):
+        """
+        Args:
+            watched (WatchedLicense): License to poll, updated with the new state.
+
+        Returns:
+            list: Events of the poll -- transition, updated, invalid or error.
+        """
+        self.polls += 1
+        timestamp = datetime.now(lsd_client.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        status_document = lsd_client.get_status_document(watched.license_document, self.device_id, self.device_name)
+        if 'Function' in status_document.keys() or 'status' not in status_document:
+            watched.errors += 1
+            return [{"event": "error", "time": timestamp, "epub_file": watched.epub_file,
+                     "message": status_document.get('Message') or status_document.get('title')}]
+        watched.errors = 0
+
+        events = list()
+        message, valid = lsd_client.fetch_status(status_document)
+        if not valid:
+            events.append({"event": "invalid", "time": timestamp, "epub_file": watched.epub_file, "message": message})
+
+        status, updated = status_document['status'], status_document.get('updated')
+        if watched.status is not None and status != watched.status:
+            events.append({"event": "transition", "time": timestamp, "epub_file": watched.epub_file,
+                           "from": watched.status, "to": status, "updated": updated})
+        elif watched.updated is not None and updated != watched.updated:
+            events.append({"event": "updated", "time": timestamp, "epub_file": watched.epub_file,
+                           "status": status, "from": watched.updated, "to": updated})
+
+        watched.status = status
+        watched.updated = updated
+        license_updated = (updated or dict()).get('license')
+        if license_updated is not None and license_updated != watched.license_updated:
+            # rights end changed with the license (e.g. a renew), potential_rights end is only the renew limit
+            self.update_license(watched, status_document, license_updated)
+        return events
+
+    def update_license(self, watched, status_document, license_updated):
+        """
+        Args:
+            watched (WatchedLicense): License whose License Document is fetched again.
+            status_document (dict): Status Document with the license link.
+            license_updated (str): updated license timestamp of the Status Document.
+        """
+        body = lsd_client.request_license_document(status_document)
+        if isinstance(body, tuple):
+            # fetched again at the next poll
+            return
+        try:
+            license_document = lsd_client.json_loads(body)
+        except ValueError:
+            return
+        watched.license_document = license_document
+        watched.license_updated = license_updated
+        watched.end = license_document.get('rights', dict()).get('end')
+
+    def _poll_and_reschedule(self, watched):
+        try:
+            for event in self.poll(watched):
+                self.on_event(event)
+        finally:
+            watched.interval = self.next_interval(watched)
+            self._schedule(watched, time.monotonic() + watched.interval)
+
+    def run(self, duration=None):
+        """
+        Args:
+            duration (float): Seconds to watch. default value: None, until stop is called
+        """
+        deadline = time.monotonic() + duration if duration is not None else None
+        next_slot = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                with self._condition:
+                    while not self._stopped:
+                        now = time.monotonic()
+                        if deadline is not None and now >= deadline:
+                            self._stopped = True
+                            break
+                        wake = min(self._heap[0][0] if self._heap else float('inf'), next_slot if self._heap else float('inf'),
+                                   deadline if deadline is not None else float('inf'))
+                        # a poll is due and the rate cap allows another request
+                        if self._heap and self._heap[0][0] <= now and next_slot <= now:
+                            break
+                        self._condition.wait(None if wake == float('inf') else max(wake, now + 0.001) - now)
+                    if self._stopped:
+                        break
+                    _, _, watched = heapq.heappop(self._heap)
+
+                next_slot = max(next_slot, time.monotonic()) + 1.0 / self.rate
+                executor.submit(self._poll_and_reschedule, watched)
+
+    def stop(self):
+        """
+        Stop run after the requests in flight.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+
+def main():
+    """
+
+    """
+
+    def usage():
+        print("Usage: lsd_watch.py [-option] [value] [Epub|Directory|Glob|Manifest]")
+        print("[option]")
+        print("-d Device id")
+        print("-n Device name")
+        print("-r Max status requests per second (default: 10)")
+        print("-w Number of concurrent requests (default: 4)")
+        print("-p Poll interval in seconds (default: 60)")
+        print("-a Shortest poll interval in seconds, used near rights end (default: 5)")
+        print("-z Longest poll interval in seconds, used for final statuses (default: 3600)")
+        print("-u Seconds to watch (default: forever)")
+        print("-s Status document schema [new|old|schema file] (default: new)")
+        print("-l License cache index file")
+        print("-E Max number of events of Status Documents kept and validated, sampled (default: all)")
+
+    args = lsd_client.parse_arguments()
+    for idx in range(len(sys.argv)):
+        if sys.argv[idx] == '-r':
+            args['rate'] = float(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-w':
+            args['workers'] = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-p':
+            args['interval'] = float(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-a':
+            args['min_interval'] = float(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-z':
+            args['max_interval'] = float(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-u':
+            args['duration'] = float(sys.argv[idx + 1])
+
+    if len(sys.argv) < 2 or not all(key in args for key in ('dev_id', 'dev_name')):
+        usage()
+        exit()
+
+    if 'schema' in args:
+        lsd_client.set_status_schema(args['schema'])
+    if 'license_cache' in args:
+        lsd_client.set_license_cache(args['license_cache'])
+    if 'event_sample' in args:
+        # long-lived licenses have long event histories, kept in the status cache for every license
+        lsd_client.set_status_event_sample(args['event_sample'])
+    licenses = dict()
+    for epub_file in lsd_batch.collect_epub_files(args['epub_file']):
+        license_document = lsd_client.get_license_document(epub_file)
+        if 'Function' in license_document.keys():
+            print(json.dumps({"event": "error", "epub_file": epub_file, "message": license_document['Message']}))
+        else:
+            licenses[epub_file] = license_document
+    if lsd_client.license_cache is not None:
+        lsd_client.license_cache.save()
+
+    # unchanged Status Documents are answered with 304 and not validated again
+    lsd_client.set_status_cache(max(1, len(licenses)))
+    lsd_client.configure_connection_pool(pool_size=args.get('workers', 4))
+    watcher = LicenseWatcher(licenses, args['dev_id'], args['dev_name'], rate=args.get('rate', 10),
+                             workers=args.get('workers', 4), interval=args.get('interval', 60),
+                             min_interval=args.get('min_interval', 5), max_interval=args.get('max_interval', 3600))
+    try:
+        watcher.run(args.get('duration'))
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""
+Name: Tests of the parsers of lsd_client.py
+File Name: test_lsd_client.py
+Files: test_lsd_client.py(Tests), lsd_client.py(Functions tested)
+Detail: lsd_client.py replaces standard library parsing with faster parsers of its own. These tests check them against
+        the standard library and the specifications, so a later performance change can not break them silently.
+    Usage
+     $ python -m unittest test_lsd_client
+     $ python -m pytest test_lsd_client.py
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from datetime import datetime, timedelta, timezone
+
+import lsd_client
+
+
+class ConvertTimeToUtcTest(unittest.TestCase):
+    """
+    convert_time_to_utc against RFC 3339 date-times.
+    """
+
+    def test_utc(self):
+        self.assertEqual(lsd_client.convert_time_to_utc('2016-09-08T10:15:30Z'),
+                         datetime(2016, 9, 8, 10, 15, 30, tzinfo=timezone.utc))
+        self.assertEqual(lsd_client.convert_time_to_utc('2016-09-08t10:15:30z'),
+                         datetime(2016, 9, 8, 10, 15, 30, tzinfo=timezone.utc))
+
+    def test_offsets(self):
+        expected = datetime(2016, 9, 8, 10, 15, 30, tzinfo=timezone.utc)
+        for text in ('2016-09-08T19:15:30+09:00', '2016-09-08T19:15:30+0900', '2016-09-08T04:45:30-05:30',
+                     '2016-09-08 10:15:30+00:00'):
+            self.assertEqual(lsd_client.convert_time_to_utc(text), expected, text)
+
+    def test_fraction(self):
+        self.assertEqual(lsd_client.convert_time_to_utc('2016-09-08T10:15:30.5Z').microsecond, 500000)
+        self.assertEqual(lsd_client.convert_time_to_utc('2016-09-08T10:15:30.123456789Z').microsecond, 123456)
+
+    def test_matches_strptime(self):
+        start = datetime(2016, 1, 1, tzinfo=timezone.utc)
+        for hours in range(0, 24 * 400, 37):
+            moment = start + timedelta(hours=hours, seconds=hours % 60)
+            for offset in (timedelta(0), timedelta(hours=9), timedelta(hours=-5, minutes=-30)):
+                text = moment.astimezone(timezone(offset)).strftime('%Y-%m-%dT%H:%M:%S%z')
+                self.assertEqual(lsd_client.convert_time_to_utc(text),
+                                 datetime.strptime(text, '%Y-%m-%dT%H:%M:%S%z'), text)
+
+    def test_invalid(self):
+        for text in ('', '2016-09-08', '2016-09-08T10:15:30', '2016-09-08T10:15Z', '2016-09-08T10:15:30Z ',
+                     '2016-13-08T10:15:30Z', '2016-09-08T10:15:30+9:00'):
+            with self.assertRaises(ValueError, msg=text):
+                lsd_client.convert_time_to_utc(text)
+
+
+class _UnseekableWriter(io.RawIOBase):
+    # ZipFile writes data descriptors after the entries when it can not seek back
+    def __init__(self, raw):
+        self.raw = raw
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.raw.write(data)
+
+
+class ReadZipEntryTest(unittest.TestCase):
+    """
+    read_zip_entry against zipfile.ZipFile on archives written in several ways.
+    """
+    ENTRY = 'META-INF/license.lcpl'
+    DATA = b'{"id": "license", "text": "' + b'lcp ' * 200 + b'"}'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_zip(self, name, compression, prefix=b''):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as output:
+            output.write(prefix)
+            with zipfile.ZipFile(output, 'w', compression) as zf:
+                zf.writestr('mimetype', 'application/epub+zip')
+                zf.writestr(self.ENTRY, self.DATA)
+                zf.writestr('OEBPS/content.opf', b'<package/>')
+        return path
+
+    def test_stored_and_deflated(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            path = self.write_zip('book{}.epub'.format(compression), compression)
+            self.assertEqual(lsd_client.read_zip_entry(path, self.ENTRY), self.DATA)
+            self.assertEqual(lsd_client.read_zip_entry(path, 'mimetype'), b'application/epub+zip')
+
+    def test_data_descriptor(self):
+        path = os.path.join(self.directory, 'streamed.epub')
+        with open(path, 'wb') as raw:
+            with zipfile.ZipFile(_UnseekableWriter(raw), 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(self.ENTRY, self.DATA)
+        with zipfile.ZipFile(path) as zf:
+            self.assertTrue(zf.getinfo(self.ENTRY).flag_bits & 0x08)
+        self.assertEqual(lsd_client.read_zip_entry(path, self.ENTRY), self.DATA)
+
+    def test_prefixed(self):
+        path = self.write_zip('prefixed.epub', zipfile.ZIP_DEFLATED, prefix=b'STUB' * 100)
+        self.assertEqual(lsd_client.read_zip_entry(path, self.ENTRY), self.DATA)
+        with self.assertRaises(KeyError):
+            lsd_client.read_zip_entry(path, 'missing')
+
+    def test_lzma(self):
+        path = self.write_zip('lzma.epub', zipfile.ZIP_LZMA)
+        self.assertEqual(lsd_client.read_zip_entry(path, self.ENTRY), self.DATA)
+
+    def test_comment(self):
+        path = self.write_zip('comment.epub', zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(path, 'a') as zf:
+            zf.comment = b'archive comment ' * 100
+        self.assertEqual(lsd_client.read_zip_entry(path, self.ENTRY), self.DATA)
+
+    def test_missing_entry(self):
+        path = self.write_zip('book.epub', zipfile.ZIP_DEFLATED)
+        with self.assertRaises(KeyError):
+            lsd_client.read_zip_entry(path, 'missing')
+
+    def test_bad_crc(self):
+        path = self.write_zip('corrupt.epub', zipfile.ZIP_STORED)
+        with open(path, 'rb') as zip_file:
+            content = zip_file.read()
+        with open(path, 'wb') as zip_file:
+            zip_file.write(content.replace(b'lcp lcp', b'lcp LCP', 1))
+        with self.assertRaises(ValueError):
+            lsd_client.read_zip_entry(path, self.ENTRY)
+
+
+class ParseStatusDocumentTest(unittest.TestCase):
+    """
+    parse_status_document against json.loads, and its sample of events.
+    """
+    VALID = ['{}', ' { } ', '{"a": 1}', '{"id":"x","events":[]}', '{"events": [ ] , "status":"active"}\n',
+             '{"events":[{"type":"register","id":"1"},{"type":"return","id":"2"}],"links":[{"rel":"license"}]}',
+             '{"events": [1, "two", null, true, [3], {"four": 4.5e1}]}', '{"events": null}', '{"events": {"a": []}}',
+             '{"a": "\\u00e9\\"}", "events": ["]", ",", "\\"]"]}', '{"a": 1, "a": 2}', '[1, 2]', '"text"', '3']
+    INVALID = ['', ' ', '{', '{"a"}', '{"a":}', '{"a":1,}', '{"a":1 "b":2}', '{a:1}', '{"events":[1,]}',
+               '{"events":[1 2]}', '{"events":[1', '{"events":[', '{"events":[}', '{"a":1} x', '{"a":1}}',
+               '{"events":[1]} ]', '{} {}', '[1,]', '{"a": tru}']
+
+    def test_matches_json_loads(self):
+        for text in self.VALID:
+            document, _ = lsd_client.parse_status_document(text, sample_size=100)
+            self.assertEqual(document, json.loads(text), text)
+            self.assertEqual(lsd_client.parse_status_document(text.encode('utf-8'))[0], json.loads(text), text)
+
+    def test_invalid_like_json_loads(self):
+        for text in self.INVALID:
+            with self.assertRaises(ValueError, msg=text):
+                json.loads(text)
+            with self.assertRaises(ValueError, msg=text):
+                lsd_client.parse_status_document(text)
+
+    def test_event_count(self):
+        self.assertIsNone(lsd_client.parse_status_document('{"status": "ready"}')[1])
+        self.assertEqual(lsd_client.parse_status_document('{"events": []}')[1], 0)
+        self.assertEqual(lsd_client.parse_status_document('{"events": [1, 2, 3]}')[1], 3)
+
+    def test_sample(self):
+        events = [{"type": "register", "id": str(idx)} for idx in range(1000)]
+        text = json.dumps({"status": "active", "events": events, "links": [{"rel": "license", "href": "x"}]})
+        for sample_size in (0, 1, 10, 999, 1000, 2000):
+            document, count = lsd_client.parse_status_document(text, sample_size)
+            self.assertEqual(count, 1000)
+            self.assertEqual(len(document['events']), min(sample_size, 1000))
+            # a subset of the events, in document order
+            indexes = [int(event['id']) for event in document['events']]
+            self.assertEqual(indexes, sorted(set(indexes)))
+            self.assertEqual(document['links'], [{"rel": "license", "href": "x"}])
+        # the same document gives the same sample
+        self.assertEqual(lsd_client.parse_status_document(text, 10), lsd_client.parse_status_document(text, 10))
+
+
+
+class UriTemplateTest(unittest.TestCase):
+    """
+    UriTemplate against the examples of RFC 6570, and the links of License and Status Documents.
+    """
+    VARIABLES = {'var': 'value', 'hello': 'Hello World!', 'path': '/foo/bar', 'x': '1024', 'y': '768', 'empty': '',
+                 'keys': None, 'half': '50%25 a%z'}
+    EXAMPLES = [('{var}', 'value'), ('{hello}', 'Hello%20World%21'), ('{+hello}', 'Hello%20World!'),
+                ('{+path}/here', '/foo/bar/here'), ('{#hello}', '#Hello%20World!'), ('map?{x,y}', 'map?1024,768'),
+                ('{.x,y}', '.1024.768'), ('{/var,x}/here', '/value/1024/here'), ('{;x,y,empty}', ';x=1024;y=768;empty'),
+                ('{?x,y,empty}', '?x=1024&y=768&empty='), ('?fixed=yes{&x}', '?fixed=yes&x=1024'), ('{?keys}', ''),
+                ('{?keys,x}', '?x=1024'), ('{x,empty}', '1024,'), ('{+half}', '50%25%20a%25z'),
+                ('no/expression', 'no/expression')]
+
+    def test_rfc_examples(self):
+        for template, expected in self.EXAMPLES:
+            self.assertEqual(lsd_client.UriTemplate(template).expand(self.VARIABLES), expected, template)
+            self.assertEqual(lsd_client.expand_uri_template(template, self.VARIABLES), expected, template)
+
+    def test_unsupported(self):
+        for template in ('{}', '{var:3}', '{list*}', '{?x,}', '{a b}'):
+            with self.assertRaises(ValueError, msg=template):
+                lsd_client.UriTemplate(template)
+
+    def test_generate_query(self):
+        template = 'https://lsd.example.com/licenses/1/register{?id,name}'
+        self.assertEqual(lsd_client.generate_query(template, 'id 1', 'name&device'),
+                         'https://lsd.example.com/licenses/1/register?id=id%201&name=name%26device')
+        self.assertEqual(lsd_client.generate_query(template, device_id='1'),
+                         'https://lsd.example.com/licenses/1/register?id=1')
+        self.assertEqual(lsd_client.generate_query('https://lsd.example.com/renew{?end,id,name}', '1', 'a',
+                                                   '2030-01-01T00:00:00+09:00'),
+                         'https://lsd.example.com/renew?end=2030-01-01T00%3A00%3A00%2B09%3A00&id=1&name=a')
+
+
+class LinkIndexTest(unittest.TestCase):
+    """
+    LinkIndex and get_link_index on links of the old specification and of LSD 1.0.
+    """
+    OLD = {'license': {'href': 'https://lsd.example.com/license',
+                       'type': 'application/vnd.readium.lcp.license.v1.0+json'},
+           'register': {'href': 'https://lsd.example.com/register{?id,name}', 'templated': True}}
+    NEW = [{'rel': 'license', 'href': 'https://lsd.example.com/license.html', 'type': 'text/html'},
+           {'rel': 'license', 'href': 'https://lsd.example.com/license',
+            'type': 'application/vnd.readium.lcp.license.v1.0+json'},
+           {'rel': ['register', 'device'], 'href': 'https://lsd.example.com/register{?id,name}', 'templated': True}]
+
+    def test_old_and_new(self):
+        for links in (self.OLD, self.NEW):
+            index = lsd_client.LinkIndex(links)
+            self.assertEqual(index.href('license', 'application/vnd.readium.lcp.license.v1.0+json'),
+                             'https://lsd.example.com/license')
+            self.assertEqual(index.expand('register', {'id': '1', 'name': 'a b'}),
+                             'https://lsd.example.com/register?id=1&name=a%20b')
+            with self.assertRaises(KeyError):
+                index.get('renew')
+            with self.assertRaises(KeyError):
+                index.get('license', 'application/pdf')
+        new = lsd_client.LinkIndex(self.NEW)
+        self.assertEqual(new.href('license'), 'https://lsd.example.com/license.html')
+        self.assertIs(new.get('device'), new.get('register'))
+
+    def test_get_link_index(self):
+        document = {'id': '1', 'links': list(self.NEW)}
+        index = lsd_client.get_link_index(document)
+        self.assertIs(lsd_client.get_link_index(document), index)
+        self.assertIs(lsd_client.get_link_index({'links': document['links']}), index)
+        # another links object, even an equal one, has its own index
+        self.assertIsNot(lsd_client.get_link_index({'links': list(self.NEW)}), index)
+
+
+if __name__ == "__main__":
+    unittest.main()